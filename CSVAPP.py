@@ -1,26 +1,69 @@
-import subprocess
+import time
+START_TIME = time.perf_counter()  # For the startup timing report
+from importTimer import ImportTimer
+import_timer = ImportTimer().install()  # Timed until the imports below are done, see Diagnostics
 import tkinter as tk
 from tkinter import ttk
 import sv_ttk
 import requests
 import pandas as pd
-from io import StringIO
-from datetime import datetime
+import numpy as np
 import threading
+import queue
+import hashlib
+import re
+from collections import Counter
 from tkinter import messagebox
-from tkcalendar import DateEntry
+from tkinter import filedialog
 import os
+import sys
 from sys import platform
-import urlFileChecker
-import babel.numbers
-
-import webbrowser
-from PIL import Image, ImageTk
+# The data side of the app lives in targetCore so it can run without a window
+from targetCore import (
+    ACTIVITY_TYPES, BUSINESS_UNITS, DISPLAY_COLUMNS, ENVIRONMENTS, ID_COLUMN, EditJournal, ExpiryIndex,
+    LinkChecker, QueryEngine, apply_delta, build_saved_dataset, compute_render_data, dataset_urls,
+    dead_link_rows, export_rows, fetch_dataset, http_client, line_id, link_status_text, live_column,
+    load_cached_dataset, open_change_stream, prepare_import, read_changes, read_rows, row_to_line, save_cache,
+    send_edits, send_rows_batch, set_df_row,
+)
+# Imported where they're used, none of them is needed to show the window.
+# targetCLI.py startup fails if one of them is imported at startup again.
+DEFERRED_IMPORTS = ['PIL', 'tkcalendar', 'babel', 'webbrowser', 'bsdiff4']
+import_timer.uninstall()
+IMPORT_SECONDS = time.perf_counter() - START_TIME
 SERVER_URL = "http://webp.mts-studios.com:5000/current_version_target"
 currentVersion = "1.1.1"
-headers = {
-    'User-Agent': 'targetLookUp/1.0'
-}
+# How long typing has to pause before the search runs
+FILTER_DEBOUNCE_MS = 150
+# Change notifications from the server's /events stream
+EVENT_RETRY_MAX = 60  # Longest wait in seconds before reconnecting
+EVENT_POLL_MS = 250
+# More new rows than this in one server change are loaded by rebuilding instead of row by row
+PATCH_ROW_LIMIT = 100
+# How many import problems the confirmation dialog lists
+IMPORT_ERRORS_SHOWN = 10
+# Titles listed per group in the overlap report
+OVERLAP_TITLES_SHOWN = 20
+# Edits made within this long of each other go to the server in one request
+SYNC_DELAY_MS = 500
+SYNC_RETRY_MAX = 300  # Longest wait in seconds before sending queued edits again
+# Patched rows are written to the on-disk cache once changes have settled for this long
+CACHE_SAVE_DELAY_MS = 5000
+# How many conflicting edits the conflict dialog lists
+CONFLICTS_SHOWN = 10
+# Updates. The manifest at SERVER_URL looks like
+#   {"version": "1.2.0", "download_url": ..., "sha256": ..., "changelog": ...,
+#    "patches": {"1.1.1": {"url": ..., "sha256": ...}}}
+# where patches are bsdiff4 patches from an older exe to this one, by older version.
+UPDATE_FILE = 'latest_app.exe'
+UPDATE_CHUNK_SIZE = 1024 * 1024
+UPDATE_TIMEOUT = (5, 60)
+UPDATE_ATTEMPTS = 3  # A dropped download carries on from where it stopped this many times
+UPDATE_PROGRESS_MS = 200
+# major[.minor[.patch]][-prerelease][+build], with or without a leading v
+VERSION_PATTERN = re.compile(r'[vV]?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$')
+# Longest the expiry timer sleeps in one go, so a changed system clock or a sleeping laptop catches up
+EXPIRY_CHECK_MAX_MS = 60 * 60 * 1000
 
 class CSVApp:
     def __init__(self, root):
@@ -36,6 +79,56 @@ class CSVApp:
         self.business_unit_var = tk.StringVar()
         self.environment_var = tk.StringVar()
         self.activity_combobox = None
+        self.df = pd.DataFrame()
+        self.cache = None
+        self.row_lines = []
+        # Row ids by DataFrame position and back. They are the Treeview item ids,
+        # rows the server hasn't given an id yet have a made-up 'new-N' one.
+        self.row_ids = []
+        self.positions = {}
+        self.pending_adds = {}  # Line without the id -> made-up id, for our new rows on their way to the server
+        self.next_local_id = 0
+        # Our edits waiting for the server, sent in batches by flush_edits
+        self.journal = EditJournal()
+        self.syncing = False
+        self.sync_timer = None
+        self.sync_retry = 0
+        self.cache_save_timer = None
+        self.next_local_id = max([int(entry['id'][4:]) for entry in self.journal.entries
+                                  if entry['id'].startswith('new-')], default=0)
+        # Treeview values and tags for every DataFrame row, see compute_render_data
+        self.row_values = []
+        self.row_tags = []
+        # Live rows waiting to expire and the timer for the next one
+        self.expiry_index = ExpiryIndex([], [])
+        self.expiry_timer = None
+        self.query_engine = QueryEngine(pd.DataFrame())
+        self.filter_scheduler = FilterScheduler(self.root, self.on_filtered)
+        # Virtual list state: DataFrame positions that pass the filter and the first one on screen
+        self.visible_positions = np.array([], dtype=np.intp)
+        self.first_row = 0
+        self.page_rows = 0
+        self.selected_id = None  # Row id of the selected row, kept while it's scrolled out of the window
+        # Column the table is sorted by (a DataFrame column name), None for file order
+        self.sort_column = None
+        self.sort_descending = False
+        # Results of background work waiting to be handled on the Tk thread
+        self.ui_queue = queue.Queue()
+        self.ui_poll_id = None
+        self.background_jobs = 0
+        self.offline = False
+        self.startup_times = {'imports': IMPORT_SECONDS}
+        # Server push: loading is set while a fetch/rebuild runs, stale if a change came in meanwhile
+        self.change_listener = None
+        self.loading = False
+        self.stale = False
+        # URL health: made on the first check, positions of rows with a URL that doesn't work
+        self.link_checker = None
+        self.checking_links = False
+        self.dead_link_positions = set()
+        # Update download: (bytes done, total) while it runs, set from the worker thread
+        self.update_progress = None
+        self.update_window = None
 
         def resource_path(relative_path):
             try:
@@ -70,20 +163,25 @@ class CSVApp:
         
         # Filter comboboxes
         ttk.Label(search_frame, text="Activity Type:").pack(side=tk.LEFT, padx=5)
-        self.activity_combobox_filter = ttk.Combobox(search_frame, values=["","activity", "A/B"], postcommand=self.filter_treeview)
+        self.activity_combobox_filter = ttk.Combobox(search_frame, values=[""] + ACTIVITY_TYPES)
         self.activity_combobox_filter.pack(side=tk.LEFT, fill=tk.X, padx=5)
 
         ttk.Label(search_frame, text="Live:").pack(side=tk.LEFT, padx=5)
-        self.live_combobox_filter = ttk.Combobox(search_frame, values=["","True", "False"], postcommand=self.filter_treeview)
+        self.live_combobox_filter = ttk.Combobox(search_frame, values=["","True", "False"])
         self.live_combobox_filter.pack(side=tk.LEFT, fill=tk.X, padx=5)
 
         ttk.Label(search_frame, text="Business Unit:").pack(side=tk.LEFT, padx=5)
-        self.business_unit_combobox_filter = ttk.Combobox(search_frame, values=["","Corp", "School", "HigherEd", "Sharpen", "Professional"], postcommand=self.filter_treeview)
+        self.business_unit_combobox_filter = ttk.Combobox(search_frame, values=[""] + BUSINESS_UNITS)
         self.business_unit_combobox_filter.pack(side=tk.LEFT, fill=tk.X, padx=5)
+
+        ttk.Label(search_frame, text="Environment:").pack(side=tk.LEFT, padx=5)
+        self.environment_combobox_filter = ttk.Combobox(search_frame, values=[""] + ENVIRONMENTS)
+        self.environment_combobox_filter.pack(side=tk.LEFT, fill=tk.X, padx=5)
         
         self.activity_combobox_filter.bind("<<ComboboxSelected>>", lambda e: self.filter_treeview())
         self.live_combobox_filter.bind("<<ComboboxSelected>>", lambda e: self.filter_treeview())
         self.business_unit_combobox_filter.bind("<<ComboboxSelected>>", lambda e: self.filter_treeview())
+        self.environment_combobox_filter.bind("<<ComboboxSelected>>", lambda e: self.filter_treeview())
 
 
         
@@ -98,26 +196,41 @@ class CSVApp:
         self.tree.column('GeoTarget', width=80)  # Adjust the width as needed
         self.tree.heading('URLs', text='URLs')  # Hidden from view
         self.tree.heading('Live', text='Live')  # Hidden from view
-        self.tree.heading('End Date', text='End Date')  # Hidden from view
+        self.tree.heading('End Date', text='End Date')
         self.tree.heading("Environment", text="Environment")
         self.tree.column("Environment", width=150)
         self.tree.column("Environment", width=150)
         self.tree.column('URLs', width=0, stretch=tk.NO)  
         self.tree.column('Live', width=0, stretch=tk.NO)  
-        self.tree.column('End Date', width=0, stretch=tk.NO)  # Hide the End Date column
+        self.tree.column('End Date', width=90)
+        # Clicking a heading sorts by that column, again for descending, a third time back to file order
+        for heading, column in zip(self.tree['columns'], DISPLAY_COLUMNS):
+            self.tree.heading(heading, command=lambda heading=heading, column=column: self.sort_by(heading, column))
         self.tree.pack(pady=20, fill=tk.BOTH, expand=True)
         self.tree.bind("<ButtonRelease-1>", self.on_item_click)
+        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+        self.tree.tag_configure('live', foreground='green')
+        self.tree.tag_configure('not_live', foreground='red')
+        self.tree.tag_configure('expired', foreground='orange', background='#2c2c2c')  # Highlight with a different color
+        self.tree.tag_configure('dead_link', background='#5c1f1f')  # A URL in the row doesn't work
         
         # Add a Scrollbar
-        self.scrollbar = ttk.Scrollbar(main_frame, orient='vertical', command=self.tree.yview)
-        self.tree.configure(yscrollcommand=self.scrollbar.set)
+        # Only the rows on screen exist as Tk items, so the scrollbar drives our own window
+        self.scrollbar = ttk.Scrollbar(main_frame, orient='vertical', command=self.on_scroll)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.bind("<Configure>", self.on_tree_resize)
+        self.tree.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.tree.bind("<Button-4>", self.on_mouse_wheel)
+        self.tree.bind("<Button-5>", self.on_mouse_wheel)
+        self.tree.bind("<Up>", lambda e: self.on_arrow_key(-1))
+        self.tree.bind("<Down>", lambda e: self.on_arrow_key(1))
         
         # Text widget to display multiple URLs and live status
         self.info_text = tk.Text(main_frame, height=7)
         self.info_text.pack(pady=20, fill=tk.BOTH)
         
-        self.add_button = ttk.Button(main_frame, text="Add New Entry", command=self.open_add_entry_popup)
+        # Both wait for the first data, there are no columns to add a row to before it
+        self.add_button = ttk.Button(main_frame, text="Add New Entry", command=self.open_add_entry_popup, state=tk.DISABLED)
         self.add_button.pack(pady=10, padx=5, side=tk.LEFT)
         self.edit_button = ttk.Button(main_frame, text="Edit Entry", command=self.open_edit_entry_popup, state=tk.DISABLED)  # Start disabled
         self.edit_button.pack(pady=10, padx=5, side=tk.LEFT)
@@ -127,27 +240,51 @@ class CSVApp:
         self.clear_filter_btn.pack(pady=10, padx=5, side=tk.RIGHT)  # You can adjust the placement using pack, grid or place as per your layout.
 
         self.setup_menu()
-        # Fetch and Load CSV data
-        self.load_data()
-        is_update_available(currentVersion)
+        # Nothing below blocks: the window shows up right away, the cached data is
+        # read and then revalidated against the server in the background, and the
+        # update check runs alongside
+        self.root.after_idle(lambda: self.record_startup('first paint'))
+        self.run_in_background(load_cached_dataset, self.on_cached_data_loaded)
         self.periodic_check_for_updates()
-        self.show_changelog()
-        
-    def check_for_updates_at_start(self):
-        # Check for updates
-        update_available, download_url, changelog = is_update_available(currentVersion)
-        if update_available:
-            answer = messagebox.askyesno("Update Available", "An update is available. Do you want to download and install it?")
-            if answer:
-                download_success = download_update(download_url, changelog)  # Pass the download URL
-                if download_success:
-                    apply_update()
-                    messagebox.showinfo("Update Successful", "The application was updated successfully. Please restart the application to use the new version.")
-                    self.quit()
-            return True
-        else:
-            return False
-        
+        self.root.after(0, self.show_changelog)
+
+    def run_in_background(self, work, on_done):
+        # work runs on its own thread, on_done gets its result on the Tk thread
+        def runner():
+            try:
+                result = work()
+            except Exception as e:
+                print(f"Error in background task: {e}")
+                result = None
+            self.ui_queue.put((on_done, result))
+
+        self.background_jobs += 1
+        thread = threading.Thread(target=runner)
+        thread.daemon = True
+        thread.start()
+        if self.ui_poll_id is None:
+            self.ui_poll_id = self.root.after(50, self.process_ui_queue)
+
+    def process_ui_queue(self):
+        self.ui_poll_id = None
+        while not self.ui_queue.empty():
+            on_done, result = self.ui_queue.get_nowait()
+            self.background_jobs -= 1
+            on_done(result)
+        if self.background_jobs and self.ui_poll_id is None:
+            self.ui_poll_id = self.root.after(50, self.process_ui_queue)
+
+    def record_startup(self, name):
+        # Seconds since the process started, only the first time each step happens
+        if name not in self.startup_times:
+            self.startup_times[name] = time.perf_counter() - START_TIME
+            if name == 'fresh data':
+                print(self.startup_report())
+
+    def startup_report(self):
+        steps = sorted(self.startup_times.items(), key=lambda step: step[1])
+        return "Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in steps)
+
     def update_menu_button_text(self, update_available):
         # Set button text based on whether an update is available
         btn_text = "≡"
@@ -176,172 +313,600 @@ class CSVApp:
         # Dropdown menu for the hamburger menu button
         self.dropdown_menu = tk.Menu(self.root, tearoff=0)
         self.dropdown_menu.add_command(label="Check for Updates", command=self.check_and_update)
+        self.dropdown_menu.add_command(label="Import Entries...", command=self.import_entries)
+        self.dropdown_menu.add_command(label="Export...", command=self.export_entries)
+        self.dropdown_menu.add_command(label="Check Links", command=self.check_links)
+        self.dropdown_menu.add_command(label="Overlapping Activities", command=self.show_overlaps)
+        self.dropdown_menu.add_command(label="Diagnostics", command=self.show_diagnostics)
         self.dropdown_menu.add_command(label="About", command=self.show_about)
         
+    def import_entries(self):
+        # Check a whole CSV/JSON file of new entries on a worker thread, then
+        # send the good ones to the server in one go
+        if self.offline or self.cache is None:
+            messagebox.showerror("Import", "Importing needs a connection to the server.")
+            return
+        path = filedialog.askopenfilename(title="Import Entries", filetypes=[("CSV or JSON", "*.csv *.json"), ("All files", "*.*")])
+        if not path:
+            return
+
+        existing = self.df[['title', 'url']].copy()
+        columns = list(self.df.columns)
+        self.run_in_background(lambda: prepare_import(path, existing, columns), self.on_import_prepared)
+
+    def on_import_prepared(self, result):
+        if result is None:
+            messagebox.showerror("Import", "The file could not be read.")
+            return
+
+        summary = f"{len(result['lines'])} new entries, {result['skipped']} already there, {len(result['errors'])} with problems."
+        if result['errors']:
+            summary += "\n\n" + "\n".join(result['errors'][:IMPORT_ERRORS_SHOWN])
+            if len(result['errors']) > IMPORT_ERRORS_SHOWN:
+                summary += f"\n... and {len(result['errors']) - IMPORT_ERRORS_SHOWN} more"
+        if not result['lines']:
+            messagebox.showinfo("Import", summary)
+            return
+        if not messagebox.askyesno("Import", summary + "\n\nUpload the new entries to the server?"):
+            return
+
+        version = self.cache['version']
+        self.run_in_background(lambda: send_rows_batch(result['lines'], version, result['header']), self.on_import_sent)
+
+    def on_import_sent(self, response):
+        if response is not None and response.status_code == 200:
+            # The new rows come back through the change stream or the next sync
+            self.sync_with_server()
+            messagebox.showinfo("Import", f"{response.json().get('added')} entries added.")
+        elif response is not None and response.status_code == 409:
+            messagebox.showerror("Conflict", "The column layout on the server changed. Refresh the data and try again.")
+        else:
+            messagebox.showerror("Error", "Import failed!")
+
+    def export_entries(self):
+        # The rows currently shown, so a filtered view exports just that
+        path = filedialog.asksaveasfilename(title="Export", defaultextension=".csv",
+                                            filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if not path:
+            return
+        try:
+            export_rows(self.df.iloc[self.visible_positions], path)
+        except Exception as e:
+            print(f"Error exporting: {e}")
+            messagebox.showerror("Error", "Export failed!")
+
+    def check_links(self):
+        # Every URL in the data, checked on worker threads. Recently checked ones
+        # come from the link cache, so running it again is quick.
+        if self.checking_links:
+            return
+        if self.link_checker is None:
+            self.link_checker = LinkChecker()
+        self.checking_links = True
+        urls = dataset_urls(self.df)
+        checker = self.link_checker
+        self.run_in_background(lambda: checker.check_all(urls), self.on_links_checked)
+
+    def on_links_checked(self, results):
+        self.checking_links = False
+        if results is None:
+            messagebox.showerror("Check Links", "The links could not be checked.")
+            return
+        self.update_dead_links()
+        self.render_window()
+        dead = sum(not result['ok'] for result in results.values())
+        messagebox.showinfo("Check Links", f"{len(results)} links checked, {dead} not working, "
+                                           f"in {len(self.dead_link_positions)} entries (highlighted).")
+
+    def update_dead_links(self):
+        if self.link_checker is None:
+            return
+        self.dead_link_positions = set(np.flatnonzero(dead_link_rows(self.df, self.link_checker.snapshot())).tolist())
+
+    def show_overlaps(self):
+        # Live activities running on the same page in the same environment
+        report = self.query_engine.url_index.overlaps()
+        titles = self.df['title'].tolist() if 'title' in self.df.columns else []
+
+        lines = [f"{len(report)} pages with more than one live activity\n"]
+        for group in report:
+            lines.append(f"{group['environment'] or '(no environment)'}: {len(group['positions'])} live activities on")
+            lines.extend("    " + url for url in group['urls'])
+            shown = group['positions'][:OVERLAP_TITLES_SHOWN]
+            lines.extend("      - " + str(titles[position]) for position in shown if position < len(titles))
+            if len(group['positions']) > len(shown):
+                lines.append(f"      ... and {len(group['positions']) - len(shown)} more")
+            lines.append("")
+
+        overlap_win = tk.Toplevel(self.root)
+        overlap_win.title("Overlapping Activities")
+        text_widget = tk.Text(overlap_win, wrap=tk.NONE, width=100, height=30)
+        scrollbar = ttk.Scrollbar(overlap_win, orient='vertical', command=text_widget.yview)
+        text_widget.config(yscrollcommand=scrollbar.set)
+        text_widget.insert(tk.END, "\n".join(lines))
+        text_widget.config(state=tk.DISABLED)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        text_widget.pack(fill=tk.BOTH, expand=True)
+
+    def show_diagnostics(self):
+        messagebox.showinfo("Diagnostics", self.startup_report() + "\n\n" + import_timer.report() +
+                            "\n\nServer calls:\n" + http_client.report())
+
     def show_menu(self):
         # Display the dropdown menu below the menu button
         self.dropdown_menu.post(self.menu_button.winfo_rootx(), self.menu_button.winfo_rooty() + self.menu_button.winfo_height())
 
-    def load_data(self):
-        # Reset the DataFrame
-        self.df = pd.DataFrame()
+    def load_data(self, work=None):
+        # Fetch from the server in the background, the table keeps working meanwhile.
+        # work replaces the fetch, it has to return what fetch_dataset does.
+        self.loading = True
+        self.refresh_button.config(state=tk.DISABLED)
+        self.run_in_background(work or self.fetch_dataset, self.on_data_loaded)
+
+    def fetch_dataset(self):
+        # Runs on a worker thread
+        return fetch_dataset(self.cache)
+
+    def on_data_loaded(self, result):
+        self.loading = False
+        self.refresh_button.config(state=tk.NORMAL)
+        if result is not None:
+            self.set_offline(result['status'] == 'offline')
+            if 'df' in result:
+                self.set_dataset(result)
+            self.record_startup('fresh data')
+
+        if self.change_listener is None:
+            # From here on the server tells us about changes
+            self.change_listener = ChangeListener(self.root, self.on_server_change, self.on_server_hello)
+            self.change_listener.start()
+        if self.stale:
+            self.stale = False
+            self.sync_with_server()
+
+    def sync_with_server(self):
+        # Catch up through /delta, or as soon as the load that's running is done
+        if self.loading:
+            self.stale = True
+        else:
+            self.load_data()
+
+    def on_server_hello(self, hello):
+        # Sent when the change stream (re)connects, changes pushed while it was
+        # down are missing unless the versions match
+        if self.cache is not None and hello.get('version') != self.cache['version']:
+            self.sync_with_server()
+
+    def on_server_change(self, change):
+        # A change pushed by the server, see ChangeListener
+        if self.loading:
+            self.stale = True
+            return
+        if self.cache is None or change.get('version') == self.cache['version']:
+            return  # Nothing to patch yet, or we already have it (our own edit)
+        if change.get('reset') or change.get('previous') != self.cache['version'] \
+                or change.get('header') != self.cache['header']:
+            self.sync_with_server()  # We missed something in between
+            return
 
-        url = urlFileChecker.url
-        headers = urlFileChecker.headers
-        response = requests.get(url, headers=headers)
-        
-        # Check for successful response before processing the CSV data
-        if response.status_code == 200:
-            csv_data = StringIO(response.text)
-            
-            self.df = pd.read_csv(csv_data, sep=',')
+        removed = change.get('removed', [])
+        added = change.get('added', [])
+        self.cache['rows'] = apply_delta(self.cache['rows'], removed, added)
+        self.cache['version'] = change['version']
+        self.set_offline(False)
 
-            self.populate_tree()
+        if self.patch_rows(removed, added):
+            self.save_cache_later()
         else:
-            # Handle potential error (e.g., invalid token, server error, etc.)
-            print(f"Error {response.status_code}: {response.text}")
-
-
-    def populate_tree(self):
-        self.tree.delete(*self.tree.get_children()) 
-        for _, row in self.df.iterrows():
-            title = row['title']
-            urls = row['url']
-            live_status = row['live']
-            end_date = row['end date']
-            activity_type = row['activity']
-            geo_target = row['geo_target']
-            business_unit = row['business_unit']
-            environment = row['environment']
-            
-            # Check if the end date has passed and is marked as live
-            is_expired = False
-            if str(live_status).lower() == "true" and end_date != "N/A" and isinstance(end_date, str):
-                try:
-                    date_format = "%Y-%m-%d"  # Assuming the date format in the CSV is 'YYYY-MM-DD'
-                    end_date_obj = datetime.strptime(end_date, date_format)
-                    if end_date_obj.date() < datetime.now().date():
-                        is_expired = True
-                except ValueError:
-                    pass
-
-
-            activity_type = row.iloc[1]
-            geo_target = row.iloc[2]
-            business_unit = row.get('business_unit', '')
-            item = self.tree.insert('', tk.END, values=(title, activity_type, geo_target, business_unit, urls, live_status, end_date, environment))
-            
-            # Visual indication based on live status and expiration
-            if is_expired:
-                self.tree.item(item, tags='expired')
-            elif str(live_status).lower() == "true":
-                self.tree.item(item, tags='live')
+            # Taken now, anything that comes in during the rebuild is fetched after it
+            cache = dict(self.cache, rows=list(self.cache['rows']))
+            self.load_data(lambda: build_saved_dataset(cache, 'changed'))
+
+    def save_cache_later(self):
+        if self.cache_save_timer is not None:
+            self.root.after_cancel(self.cache_save_timer)
+        self.cache_save_timer = self.root.after(CACHE_SAVE_DELAY_MS, self.save_current_cache)
+
+    def save_current_cache(self):
+        # The cache file keeps the parsed frame and search index with the rows
+        # so the next start doesn't parse anything. They're copies of what's on
+        # screen, in row_lines order, which only matches the server's rows when
+        # none of our edits are waiting. Until then only the rows are saved.
+        self.cache_save_timer = None
+        if self.cache is None:
+            return
+        if self.journal.entries or Counter(self.row_lines) != Counter(self.cache['rows']):
+            cache = dict(self.cache, rows=list(self.cache['rows']))
+            df = search_index = None
+        else:
+            cache = dict(self.cache, rows=list(self.row_lines))
+            df = self.df.copy()
+            search_index = self.query_engine.search_index.snapshot()
+        self.run_in_background(lambda: save_cache(cache, df, search_index), lambda result: None)
+
+    def patch_rows(self, removed, added):
+        # Bring the table in line with a server change without rebuilding it.
+        # Rows are matched by id, so a row we know is replaced where it is and
+        # a new one appended. Our own edits come back unchanged and are skipped,
+        # rows we have edits queued for keep ours until the sync says who wins.
+        # Returns False if rows have to go, that shifts every position after them.
+        if ID_COLUMN not in self.df.columns:
+            return False
+        added_ids = {line_id(line) for line in added}
+        if any(line_id(line) in self.positions and line_id(line) not in added_ids for line in removed):
+            return False
+
+        changed = []
+        new_rows = 0
+        edited = self.journal.row_ids()
+        for line in added:
+            position = self.positions.get(line_id(line))
+            if position is None:
+                position = self.claim_pending_add(line)
+                if position is not None:
+                    continue  # Our own new row, now with its id
+                new_rows += 1
+            elif self.row_lines[position] == line or line_id(line) in edited:
+                continue
+            changed.append((position, line))
+        if new_rows > PATCH_ROW_LIMIT:
+            return False
+        if not changed:
+            return True
+
+        parsed = read_rows(self.cache['header'], [line for _, line in changed])
+        appended = []
+        for i, (position, line) in enumerate(changed):
+            if position is None:
+                position = len(self.row_lines)
+                self.row_lines.append(line)
+                self.add_row_id(line_id(line), position)
+                appended.append(position)
             else:
-                self.tree.item(item, tags='not_live')
+                self.row_lines[position] = line
+            set_df_row(self.df, position, parsed.iloc[i].to_dict())
+            self.update_render_row(position)
+            self.query_engine.update_row(position, self.df.iloc[position])
+            if self.tree.exists(self.row_ids[position]):
+                self.tree.item(self.row_ids[position], values=self.row_values[position], tags=self.tags_for(position))
+
+        if self.has_filters():
+            self.apply_filters(keep_scroll=True)  # The changed rows may not match any more
+        elif appended or self.sort_column is not None:
+            self.visible_positions = self.sorted_view(np.append(self.visible_positions, np.array(appended, dtype=np.intp)))
+            self.render_window()
+        return True
 
-        self.tree.tag_configure('live', foreground='green')
-        self.tree.tag_configure('not_live', foreground='red')
-        self.tree.tag_configure('expired', foreground='orange', background='#2c2c2c')  # Highlight with a different color
+    def on_cached_data_loaded(self, dataset):
+        if dataset is not None:
+            self.set_dataset(dataset)
+            self.record_startup('cached data')
+        # Now check it against the server
+        self.load_data()
 
+    def set_offline(self, offline):
+        # Edits still work without the server, they wait in the journal
+        self.offline = offline
+        self.update_title()
+
+    def update_title(self):
+        title = "Target Activity Look Up"
+        if self.offline:
+            title += " (offline)"
+        if self.journal.entries:
+            title += f" - {len(self.journal.entries)} edits waiting to sync"
+        self.root.title(title)
+
+    def set_dataset(self, dataset):
+        # self.cache is the server's copy, self.row_lines follows self.df as it gets edited
+        self.filter_scheduler.cancel()  # Pending results are for the old rows
+        top_id = self.top_row_id()
+        self.cache = dataset['cache']
+        self.row_lines = dataset['row_lines']
+        self.df = dataset['df']
+        self.index_rows()
+        # The end dates only matter to the expiry index, which has them already
+        self.row_values, self.row_tags, _ = dataset['render_data']
+        self.query_engine = dataset['query_engine']
+        self.expiry_index = dataset['expiry_index']
+        self.apply_pending_edits()
+        self.schedule_expiry()
+        self.update_dead_links()
+        self.add_button.config(state=tk.NORMAL)
+
+        self.populate_tree(top_id=top_id)
+        # Keep whatever the user is filtering on, and where they'd scrolled to
+        if self.has_filters():
+            self.apply_filters(keep_scroll=True)
+        self.schedule_sync(0)
+
+    def index_rows(self):
+        if ID_COLUMN in self.df.columns:
+            ids = self.df[ID_COLUMN].fillna('').astype(str).tolist()
+        else:
+            ids = [''] * len(self.df)
+        self.row_ids = [row_id or self.local_id() for row_id in ids]
+        self.positions = {row_id: position for position, row_id in enumerate(self.row_ids)}
+        self.pending_adds = {}
+
+    def apply_pending_edits(self):
+        # Fresh data from the server or the cache doesn't have our queued edits
+        # yet, put them back on top. Edits already on their way are left out,
+        # the server's answer or the change stream brings those in.
+        waiting = self.journal.waiting()
+        if not waiting or self.cache is None:
+            return
+        parsed = read_rows(self.cache['header'], [entry['row'] for entry in waiting])
+        for i, entry in enumerate(waiting):
+            position = self.positions.get(entry['id'])
+            if position is None:
+                if entry['op'] != 'add':
+                    continue  # Gone from the server, sending it will say so
+                position = len(self.row_lines)
+                self.row_lines.append(entry['row'])
+                self.add_row_id(entry['id'], position)
+            else:
+                self.row_lines[position] = entry['row']
+            set_df_row(self.df, position, parsed.iloc[i].to_dict())
+            self.update_render_row(position)
+            self.query_engine.update_row(position, self.df.iloc[position])
+
+    def local_id(self):
+        self.next_local_id += 1
+        return f"new-{self.next_local_id}"
+
+    def add_row_id(self, row_id, position):
+        self.row_ids.append(row_id)
+        self.positions[row_id] = position
+
+    def claim_pending_add(self, line):
+        # A row we added coming back from the server with its id. Returns its
+        # position, or None if it isn't one of ours.
+        local = self.pending_adds.pop(line.split(',', 1)[-1], None)
+        if local is None or local not in self.positions:
+            return None
+        position = self.positions.pop(local)
+        self.row_ids[position] = line_id(line)
+        self.positions[line_id(line)] = position
+        self.row_lines[position] = line
+        set_df_row(self.df, position, {ID_COLUMN: line_id(line)})
+        self.render_window()  # The Tk item still has the made-up id
+        return position
+
+    def has_filters(self):
+        return bool(self.search_var.get() or self.activity_combobox_filter.get() or self.live_combobox_filter.get()
+                    or self.business_unit_combobox_filter.get() or self.environment_combobox_filter.get())
+
+    def update_render_row(self, position):
+        row_df = self.df.iloc[[position]]
+        values, tags, end_dates = compute_render_data(row_df)
+        if position == len(self.row_values):
+            self.row_values.append(values[0])
+            self.row_tags.append(tags[0])
+        else:
+            self.row_values[position] = values[0]
+            self.row_tags[position] = tags[0]
+        self.expiry_index.update_row(position, end_dates[0], live_column(row_df)[0])
+        self.schedule_expiry()
+        if self.link_checker is not None:
+            self.dead_link_positions.discard(position)
+            if dead_link_rows(self.df.iloc[[position]], self.link_checker.snapshot())[0]:
+                self.dead_link_positions.add(position)
+
+    def schedule_expiry(self):
+        # One timer for the next row to expire
+        if self.expiry_timer is not None:
+            self.root.after_cancel(self.expiry_timer)
+            self.expiry_timer = None
+        next_expiry = self.expiry_index.next_expiry()
+        if next_expiry is None:
+            return
+        delay = (next_expiry - pd.Timestamp.now()).total_seconds() * 1000
+        self.expiry_timer = self.root.after(int(min(max(delay, 0), EXPIRY_CHECK_MAX_MS)), self.on_expiry)
+
+    def on_expiry(self):
+        # Retag just the rows that expired, the rest of the table stays as it is
+        self.expiry_timer = None
+        for position in self.expiry_index.pop_expired():
+            self.update_render_row(position)
+            if self.tree.exists(self.row_ids[position]):
+                self.tree.item(self.row_ids[position], tags=self.tags_for(position))
+        self.schedule_expiry()
+
+    def tags_for(self, position):
+        if position in self.dead_link_positions:
+            return (self.row_tags[position], 'dead_link')
+        return (self.row_tags[position],)
+
+    def populate_tree(self, positions=None, top_id=None):
+        # positions are DataFrame row positions to show, None shows everything.
+        # Only the window of rows that fits on screen gets inserted into the tree.
+        # Starts at the top, or with row top_id at the top if given. If that row
+        # isn't shown any more the scroll position stays where it was.
+        if positions is None:
+            positions = np.arange(len(self.row_values))
+        self.visible_positions = self.sorted_view(np.asarray(positions, dtype=np.intp))
+        if top_id is None:
+            self.first_row = 0
+        elif top_id in self.positions:
+            found = np.flatnonzero(self.visible_positions == self.positions[top_id])
+            if len(found):
+                self.first_row = int(found[0])
+        self.render_window()
+
+    def top_row_id(self):
+        # Row id at the top of the table, None if it's empty
+        if self.first_row < len(self.visible_positions):
+            return self.row_ids[self.visible_positions[self.first_row]]
+        return None
+
+    def sorted_view(self, positions):
+        # positions in the current sort order, file order without one
+        if self.sort_column is None:
+            return np.sort(positions)
+        return self.query_engine.sort_index.sorted_positions(positions, self.sort_column, self.sort_descending)
+
+    def sort_by(self, heading, column):
+        if self.sort_column != column:
+            self.sort_column, self.sort_descending = column, False
+        elif not self.sort_descending:
+            self.sort_descending = True
+        else:
+            self.sort_column = None
+
+        for name in self.tree['columns']:
+            self.tree.heading(name, text=name)
+        if self.sort_column is not None:
+            self.tree.heading(heading, text=heading + (' ▼' if self.sort_descending else ' ▲'))
+        self.populate_tree(self.visible_positions)
+
+    def resort(self):
+        # An edited row may belong somewhere else now, the scroll position stays
+        if self.sort_column is not None:
+            self.visible_positions = self.sorted_view(self.visible_positions)
+            self.render_window()
+
+    def render_window(self):
+        total = len(self.visible_positions)
+        page = self.page_size()
+        self.first_row = max(0, min(self.first_row, total - page))
+        window = self.visible_positions[self.first_row:self.first_row + page].tolist()
 
-    def filter_titles(self, event):
-        search_term = self.search_var.get().lower()
         self.tree.delete(*self.tree.get_children())
 
-        # Filter data where title, activity type, URL, or end date contains the search term
-        filtered_data = self.df[
-            (self.df['title'].str.lower().str.contains(search_term)) |
-            (self.df['activity'].str.lower().str.contains(search_term)) |
-            (self.df['geo_target'].astype(str).str.lower().str.contains(search_term)) |
-            (self.df['url'].astype(str).str.lower().str.contains(search_term))
-        ]
-
-        # Apply the combobox filters on top of the title filter
-        activity_type = self.activity_combobox_filter.get()
-        live_status = self.live_combobox_filter.get()
-        business_unit = self.business_unit_combobox_filter.get()
-        filtered_data = self.df[
-            (self.df['title'].str.lower().str.contains(search_term)) |
-            (self.df['activity'].str.lower().str.contains(search_term)) |
-            (self.df['geo_target'].astype(str).str.lower().str.contains(search_term)) |
-            (self.df['url'].astype(str).str.lower().str.contains(search_term))
-        ]
-
-        for _, row in filtered_data.iterrows():
-            title = row['title']
-            urls = row['url']
-            live_status = row['live']
-            end_date = row['end date']
-            activity_type = row['activity']
-            geo_target = row['geo_target']
-            business_unit = row['business_unit']
-
-            item = self.tree.insert('', tk.END, values=(title, activity_type, geo_target, business_unit, urls, live_status, end_date))
-            
-            if str(live_status).lower() == "true":
-                self.tree.item(item, tags='live')
-            else:
-                self.tree.item(item, tags='not_live')
+        # Item ids are row ids, self.positions finds the row again
+        insert = self.tree.insert
+        values = self.row_values
+        row_ids = self.row_ids
+        tags_for = self.tags_for
+        for position in window:
+            insert('', tk.END, iid=row_ids[position], values=values[position], tags=tags_for(position))
+
+        # Select the selected row again whenever it's on screen
+        if self.selected_id is not None and self.tree.exists(self.selected_id):
+            self.tree.selection_set(self.selected_id)
+
+        if total:
+            self.scrollbar.set(self.first_row / total, (self.first_row + len(window)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def page_size(self):
+        # Number of rows that fit in the tree, minus one for the headings
+        row_height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        height = self.tree.winfo_height()
+        if height <= 1:
+            # Not drawn yet, fall back to the configured height
+            return int(self.tree.cget('height'))
+        return max(1, height // row_height - 1)
+
+    def scroll_rows(self, rows):
+        self.first_row += rows
+        self.render_window()
+
+    def on_scroll(self, *args):
+        # Scrollbar command, either ('moveto', fraction) or ('scroll', count, 'units'/'pages')
+        if args[0] == 'moveto':
+            self.first_row = int(float(args[1]) * len(self.visible_positions))
+            self.render_window()
+        elif args[0] == 'scroll':
+            step = self.page_size() if args[2] == 'pages' else 1
+            self.scroll_rows(int(args[1]) * step)
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4:
+            self.scroll_rows(-3)
+        elif event.num == 5:
+            self.scroll_rows(3)
+        else:
+            self.scroll_rows(-3 * int(event.delta / 120))
+        return "break"
+
+    def on_arrow_key(self, step):
+        # Moving past the first/last row on screen scrolls the window
+        children = self.tree.get_children()
+        selected = self.tree.selection()
+        if not children or not selected:
+            return None
+        edge = children[0] if step < 0 else children[-1]
+        if selected[0] != edge:
+            return None  # Let the tree move the selection itself
+
+        # Item ids are row ids, the window is in visible_positions order
+        index = int(np.flatnonzero(self.visible_positions == self.positions[edge])[0]) + step
+        if index < 0 or index >= len(self.visible_positions):
+            return "break"
+        self.scroll_rows(step)
+        item = self.row_ids[self.visible_positions[index]]
+        self.selected_id = item
+        self.tree.selection_set(item)
+        self.tree.focus(item)
+        return "break"
+
+    def on_tree_resize(self, event):
+        page = self.page_size()
+        if page != self.page_rows:
+            self.page_rows = page
+            self.render_window()
+
+
+    def filter_titles(self, event):
+        # Wait for typing to pause before searching
+        self.apply_filters(FILTER_DEBOUNCE_MS)
 
-                
     def filter_treeview(self):
-        # Get values from the comboboxes
-        activity_type = self.activity_combobox_filter.get()
-        live_status = self.live_combobox_filter.get()
-        business_unit = self.business_unit_combobox_filter.get()
-
-        # Start with a mask that's all True (i.e., include all rows)
-        mask = [True] * len(self.df)
-
-        # Update the mask based on comboboxes' values
-        if activity_type:
-            mask = (mask) & (self.df['activity'] == activity_type)
-        if live_status:
-            # Convert the tag to a Boolean value
-            if live_status == "True":
-                live_boolean = True
-            elif live_status == "False":
-                live_boolean = False
-
-            if live_boolean is not None:
-                mask = (mask) & (self.df['live'] == live_boolean)
-        if business_unit:
-            mask = (mask) & (self.df['business_unit'] == business_unit)
-
-        filtered_data = self.df[mask]
-
-        # Clear the treeview and populate it with filtered data
-        self.tree.delete(*self.tree.get_children())
-        for _, row in filtered_data.iterrows():
-            title = row['title']
-            urls = row['url']
-            live_status_row = row['live']
-            end_date = row['end date']
-            activity_type = row['activity']
-            geo_target = row['geo_target']
-            business_unit = row['business_unit']
-            environment = row['environment']
-
-            item = self.tree.insert('', tk.END, values=(title, activity_type, geo_target, business_unit, urls, live_status_row, end_date, environment))
-            
-            if str(live_status_row).lower() == "true":
-                self.tree.item(item, tags='live')
-            else:
-                self.tree.item(item, tags='not_live')
-                
+        self.apply_filters()
+
+    def apply_filters(self, delay=0, keep_scroll=False):
+        # Search text and comboboxes are read here on the Tk thread, the rows
+        # matching all of them are worked out by the filter scheduler. A new
+        # search starts at the top, keep_scroll is for filtering the same search
+        # again after rows changed underneath it.
+        search_term = self.search_var.get()
+        filters = {
+            'activity': self.activity_combobox_filter.get(),
+            'live': self.live_combobox_filter.get(),
+            'business_unit': self.business_unit_combobox_filter.get(),
+            'environment': self.environment_combobox_filter.get(),
+        }
+        query_engine = self.query_engine
+        self.filter_scheduler.schedule(
+            lambda: (query_engine, keep_scroll, *query_engine.versioned_query(search_term, filters)), delay)
+
+    def on_filtered(self, result):
+        query_engine, keep_scroll, version, positions = result
+        if query_engine is not self.query_engine or version != query_engine.version:
+            # A row changed while this was worked out, it may match differently now
+            self.apply_filters(keep_scroll=keep_scroll)
+            return
+        self.populate_tree(positions, self.top_row_id() if keep_scroll else None)
+
     def clear_filter(self):
-        # Reset combobox selections
+        # Reset combobox selections and the search box
+        self.search_var.set('')
         self.activity_combobox_filter.set('')
         self.live_combobox_filter.set('')
         self.business_unit_combobox_filter.set('')
+        self.environment_combobox_filter.set('')
 
         # Call filter_treeview to reset the treeview data
         self.filter_treeview()
 
 
 
+    def on_tree_select(self, event):
+        # Clicks and the tree's own arrow key moves. Redrawing the window clears
+        # the selection for a moment, that doesn't count.
+        selection = self.tree.selection()
+        if selection:
+            self.selected_id = selection[0]
+
     def on_item_click(self, event):
-        selected_item = self.tree.selection()[0]
+        # Releases on a heading sort the table, and nothing may be selected yet
+        if self.tree.identify_region(event.x, event.y) == 'heading' or not self.tree.selection():
+            return
+        self.selected_id = self.tree.selection()[0]
+        selected_item = self.selected_id
         urls = self.tree.item(selected_item, "values")[4]
         live_status = self.tree.item(selected_item, "values")[5]
         end_date = self.tree.item(selected_item, "values")[6]  # Get the end date from the selected item
@@ -353,8 +918,21 @@ class CSVApp:
         self.info_text.delete(1.0, tk.END)
         self.info_text.insert(tk.END, "Title: " + title + "\n\n")
         self.info_text.insert(tk.END, "URLs: \n")
+        position = self.positions[selected_item]
+        environments = self.df['environment'].to_numpy() if 'environment' in self.df.columns else None
         for url in url_list:
-            self.info_text.insert(tk.END, url + "\n")
+            # Other live activities on the same page in the same environment
+            others = self.query_engine.url_index.rows_for(url, live_only=True)
+            others = others[others != position]
+            if environments is not None:
+                others = others[environments[others] == environments[position]]
+            notes = ""
+            if len(others):
+                notes += f"   (also in {len(others)} other live activities)"
+            if self.link_checker is not None:
+                # Status from the last Check Links
+                notes += "   [" + link_status_text(self.link_checker.result(url)) + "]"
+            self.info_text.insert(tk.END, url + notes + "\n")
         
         self.info_text.insert(tk.END, "\n")
         self.info_text.insert(tk.END, "Live: " + live_status + "\n")
@@ -362,6 +940,8 @@ class CSVApp:
         self.edit_button.config(state=tk.NORMAL)
         
     def open_add_entry_popup(self):
+        if self.cache is None:
+            return  # No data yet
         self.popup = tk.Toplevel(self.root)
         self.popup.title("Add New Entry")
 
@@ -369,19 +949,19 @@ class CSVApp:
         ttk.Entry(self.popup, textvariable=self.title_var).grid(row=0, column=1, padx=10, pady=5, sticky='e')
         
         ttk.Label(self.popup, text="Business Unit:").grid(row=7, column=0, padx=10, pady=5, sticky='w')
-        self.business_unit_combobox = ttk.Combobox(self.popup, textvariable=self.business_unit_var, values=["Corp", "School", "HigherEd", "Sharpen", "Professional"])
+        self.business_unit_combobox = ttk.Combobox(self.popup, textvariable=self.business_unit_var, values=BUSINESS_UNITS)
         self.business_unit_combobox.grid(row=7, column=1, padx=10, pady=5, sticky='e')
         self.business_unit_combobox.set("Corp")  # Set a default value
 
 
         ttk.Label(self.popup, text="Environment:").grid(row=8, column=0, padx=10, pady=5, sticky='w')
-        self.environment_combobox = ttk.Combobox(self.popup, textvariable=self.environment_var, values=["QALV", "PROD"])
+        self.environment_combobox = ttk.Combobox(self.popup, textvariable=self.environment_var, values=ENVIRONMENTS)
         self.environment_combobox.grid(row=8, column=1, padx=10, pady=5, sticky='e')
         self.environment_combobox.set("QALV")  # Set a default value
 
         
         ttk.Label(self.popup, text="Activity Type (activity or A/B):").grid(row=1, column=0, padx=10, pady=5, sticky='w')        
-        self.activity_combobox = ttk.Combobox(self.popup, textvariable=self.activity_var, values=["activity", "A/B"])
+        self.activity_combobox = ttk.Combobox(self.popup, textvariable=self.activity_var, values=ACTIVITY_TYPES)
         self.activity_combobox.grid(row=1, column=1, padx=10, pady=5, sticky='e')
         self.activity_combobox.set("activity")  # Set a default value. Change to "A/B" if needed
 
@@ -404,7 +984,7 @@ class CSVApp:
         self.check_end_date.grid(row=5, column=1, padx=10, pady=5, sticky='e')
         
         ttk.Label(self.popup, text="End Date:").grid(row=6, column=0, padx=10, pady=5, sticky='w')
-        self.end_date_entry = DateEntry(self.popup, textvariable=self.end_date_var, date_pattern='y-mm-dd')
+        self.end_date_entry = date_entry(self.popup, self.end_date_var)
         self.end_date_entry.grid(row=6, column=1, padx=10, pady=5, sticky='e')
         self.end_date_entry.config(state='disabled')  # Disable the entry by default
 
@@ -412,11 +992,12 @@ class CSVApp:
         ttk.Button(self.popup, text="Submit", command=self.add_new_entry).grid(row=9, column=0, columnspan=2, pady=10)
         
     def open_edit_entry_popup(self):
-        selected_item = self.tree.selection()[0]
-        if not selected_item:
+        # The selected row may be scrolled out of the window, or gone after a reload
+        selected_item = self.selected_id
+        if selected_item not in self.positions:
             return
 
-        data = self.tree.item(selected_item, "values")
+        data = [str(value) for value in self.row_values[self.positions[selected_item]]]
         
         self.popup = tk.Toplevel(self.root)
         self.popup.title("Edit Entry")
@@ -425,7 +1006,7 @@ class CSVApp:
         ttk.Entry(self.popup, textvariable=self.title_var).grid(row=0, column=1, padx=10, pady=5, sticky='e')
         
         ttk.Label(self.popup, text="Activity Type (activity or A/B):").grid(row=1, column=0, padx=10, pady=5, sticky='w')        
-        self.activity_combobox = ttk.Combobox(self.popup, textvariable=self.activity_var, values=["activity", "A/B"])
+        self.activity_combobox = ttk.Combobox(self.popup, textvariable=self.activity_var, values=ACTIVITY_TYPES)
         self.activity_combobox.grid(row=1, column=1, padx=10, pady=5, sticky='e')
         self.activity_combobox.set("activity")  # Set a default value. Change to "A/B" if needed
 
@@ -448,16 +1029,16 @@ class CSVApp:
         self.check_end_date.grid(row=5, column=1, padx=10, pady=5, sticky='e')
         
         ttk.Label(self.popup, text="End Date:").grid(row=6, column=0, padx=10, pady=5, sticky='w')
-        self.end_date_entry = DateEntry(self.popup, textvariable=self.end_date_var, date_pattern='y-mm-dd')
+        self.end_date_entry = date_entry(self.popup, self.end_date_var)
         self.end_date_entry.grid(row=6, column=1, padx=10, pady=5, sticky='e')
         self.end_date_entry.config(state='disabled')  # Disable the entry by default
         
         ttk.Label(self.popup, text="Business Unit:").grid(row=7, column=0, padx=10, pady=5, sticky='w')
-        self.business_unit_combobox = ttk.Combobox(self.popup, textvariable=self.business_unit_var, values=["Corp", "School", "HigherEd", "Sharpen", "Professional"])
+        self.business_unit_combobox = ttk.Combobox(self.popup, textvariable=self.business_unit_var, values=BUSINESS_UNITS)
         self.business_unit_combobox.grid(row=7, column=1, padx=10, pady=5, sticky='e')
         
         ttk.Label(self.popup, text="Environment:").grid(row=8, column=0, padx=10, pady=5, sticky='w')
-        self.environment_combobox = ttk.Combobox(self.popup, textvariable=self.environment_var, values=["QALV", "PROD"])
+        self.environment_combobox = ttk.Combobox(self.popup, textvariable=self.environment_var, values=ENVIRONMENTS)
         self.environment_combobox.grid(row=8, column=1, padx=10, pady=5, sticky='e')
         # Assuming data[7] contains the environment info
         self.environment_var.set(data[7])
@@ -482,18 +1063,21 @@ class CSVApp:
         environment = self.environment_var.get()
         end_date = 'NAN' if not self.has_end_date.get() else self.end_date_var.get()
 
-        # Update the Treeview
-        self.tree.item(item, values=(title, activity_type, geo_target, business_unit, urls, live_status, end_date, environment))
-
-        # Update the DataFrame
-        index = self.tree.index(item)
-        self.df.iloc[index] = [title, activity_type, geo_target, urls, live_status, end_date, business_unit, environment]
+        # Update the DataFrame, the item id is the row's id
+        index = self.positions[item]
+        set_df_row(self.df, index, {'title': title, 'activity': activity_type, 'geo_target': geo_target, 'url': urls, 'live': live_status, 'end date': end_date, 'business_unit': business_unit, 'environment': environment})
+        self.update_render_row(index)
+        self.query_engine.update_row(index, self.df.iloc[index])
 
+        # Update the Treeview if the row is still on screen
+        if self.tree.exists(item):
+            self.tree.item(item, values=self.row_values[index], tags=self.tags_for(index))
+        self.resort()
 
-        
-        start_upload = messagebox.askyesno("Upload to Server", "Do you want to upload the new entry to the server?")
-        if start_upload:
-            self.start_upload()
+        # Every edit goes to the server, the journal keeps it until it's there
+        old_line = self.row_lines[index]
+        self.row_lines[index] = row_to_line(self.df, index)
+        self.queue_edit(index, old_line)
 
         self.popup.destroy()
 
@@ -515,14 +1099,16 @@ class CSVApp:
 
         # Adding to the DataFrame
         new_row = {'title': title, 'activity': activity_type, 'geo_target': geo_target, 'url': urls, 'live': live_status, 'end date': end_date, 'business_unit': business_unit, 'environment': environment}
-        self.df.loc[len(self.df)] = new_row
+        set_df_row(self.df, len(self.df), new_row)
+        self.row_lines.append(row_to_line(self.df, len(self.df) - 1))
+        self.add_row_id(self.local_id(), len(self.df) - 1)
+        self.update_render_row(len(self.df) - 1)
+        self.query_engine.update_row(len(self.df) - 1, self.df.iloc[-1])
 
-        # Adding to the Treeview
-        item = self.tree.insert('', tk.END, values=(title, activity_type, geo_target, business_unit, urls, live_status, end_date, environment))
-        if str(live_status).lower() == "true":
-            self.tree.item(item, tags='live')
-        else:
-            self.tree.item(item, tags='not_live')
+        # Adding to the Treeview and scrolling to it
+        self.visible_positions = self.sorted_view(np.append(self.visible_positions, len(self.df) - 1))
+        self.first_row = int(np.flatnonzero(self.visible_positions == len(self.df) - 1)[0])
+        self.render_window()
 
         print(f"Title: {title}")
         print(f"URLs: {urls}")
@@ -530,38 +1116,141 @@ class CSVApp:
         print(f"End Date: {end_date}")
 
         print(self.df.tail())
-        start_upload = messagebox.askyesno("Upload to Server", "Do you want to upload the new entry to the server?")
-        if start_upload:
-            self.start_upload()
+        self.queue_edit(len(self.row_lines) - 1, None)
 
         # Closing the popup
         self.popup.destroy()
 
         
-    def upload_to_server(self):
-        
-        url = urlFileChecker.urlUpload
-        headers = urlFileChecker.headers
-        
-        csv_data = self.df.to_csv(index=False)
-        files = {'file': ('target.csv', csv_data)}
-        
-        response = requests.post(url, headers=headers, files=files)
-        
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "File uploaded successfully!")
-        else:
-            messagebox.showerror("Error", "File upload failed!")
-            
-    def start_upload(self):
-        thread = threading.Thread(target=self.upload_to_server)
-        thread.daemon = True
-        thread.start()
-        
+    def queue_edit(self, position, old_line):
+        # The row at position as it is now goes into the journal and out with the next batch
+        self.journal.record(self.row_ids[position], old_line, self.row_lines[position])
+        self.update_title()
+        self.schedule_sync(SYNC_DELAY_MS)
+
+    def schedule_sync(self, delay):
+        if self.sync_timer is None and not self.syncing and self.journal.waiting():
+            self.sync_timer = self.root.after(delay, self.flush_edits)
+
+    def flush_edits(self):
+        # Everything waiting in the journal in one request, on a worker thread.
+        # Only one batch is out at a time, edits made meanwhile go in the next.
+        self.sync_timer = None
+        if self.syncing or self.cache is None or not self.journal.waiting():
+            return
+        batch = self.journal.take()
+        for entry in batch:
+            if entry['op'] == 'add':
+                # The change stream may bring the new row back before the answer does
+                self.pending_adds[entry['row'].split(',', 1)[-1]] = entry['id']
+        self.syncing = True
+        version, header = self.cache['version'], self.cache['header']
+        self.run_in_background(lambda: send_edits(batch, version, header),
+                               lambda response: self.on_edits_sent(batch, response))
+
+    def on_edits_sent(self, batch, response):
+        self.syncing = False
+        if response is not None and response.status_code == 409:
+            # The column layout changed under us, these rows can't go in as they are
+            print(f"Error sending edits: {response.status_code} {response.text}")
+            self.sync_retry = 0
+            self.journal.sent()
+            self.update_title()
+            messagebox.showerror("Error", f"{len(batch)} edits could not be uploaded because the data on the server "
+                                          "changed shape. Refresh and make them again.")
+            self.sync_with_server()
+            return
+
+        if response is None or response.status_code != 200:
+            # Server down, unreachable or refusing us for now (token, rate limit,
+            # an older server): keep everything and try again later, waiting longer each time
+            self.journal.failed()
+            for entry in batch:
+                if entry['op'] == 'add':
+                    self.pending_adds.pop(entry['row'].split(',', 1)[-1], None)
+            self.set_offline(response is None)
+            if response is not None and response.status_code < 500:
+                print(f"Error sending edits: {response.status_code} {response.text}")
+                if not self.sync_retry:  # Once, not on every retry
+                    messagebox.showerror("Error", f"The server didn't take your edits (error {response.status_code}: "
+                                                  f"{response.text[:200]}). They are kept and sent again later.")
+            self.sync_retry = min(self.sync_retry * 2, SYNC_RETRY_MAX) if self.sync_retry else 1
+            self.sync_timer = self.root.after(self.sync_retry * 1000, self.flush_edits)
+            return
+
+        self.sync_retry = 0
+        result = response.json()
+        self.set_offline(False)
+        changes = Counter()
+        conflicts = []
+        refused = []
+        for entry, outcome in zip(batch, result['results']):
+            if outcome['status'] == 'ok':
+                if entry['op'] == 'add':
+                    self.claim_pending_add(outcome['row'])  # Nothing to do if the change stream was first
+                    self.journal.rename(entry['id'], outcome['row'])
+                else:
+                    changes[entry['old']] -= 1
+                changes[outcome['row']] += 1
+            elif outcome['status'] == 'conflict':
+                conflicts.append((entry, outcome.get('current')))
+            else:
+                print(f"Error: the server refused an edit: {entry}")
+                refused.append(entry['row'])
+        self.journal.sent()
+
+        # Only patch our cached copy if nobody else wrote in between, otherwise
+        # the next delta sync brings in their changes together with ours
+        if self.cache and result.get('previous') == self.cache['version']:
+            removed = [line for line, count in changes.items() for _ in range(-count)]
+            added = [line for line, count in changes.items() for _ in range(count)]
+            self.cache['rows'] = apply_delta(self.cache['rows'], removed, added)
+            self.cache['version'] = result.get('version')
+            self.save_cache_later()
+        elif self.cache and result.get('version') != self.cache['version']:
+            self.sync_with_server()
+
+        if refused:
+            # Ours and the server's copy of these rows differ now, go back to the server's
+            titles = read_rows(self.cache['header'], refused)['title'].tolist()
+            summary = "\n".join(f"- {title}" for title in titles[:CONFLICTS_SHOWN])
+            if len(refused) > CONFLICTS_SHOWN:
+                summary += f"\n... and {len(refused) - CONFLICTS_SHOWN} more"
+            messagebox.showerror("Error", f"The server refused {len(refused)} of your edits, they were not saved:\n\n"
+                                          f"{summary}\n\nThey are put back the way the server has them.")
+            if not self.loading:  # A load that's running rebuilds the table anyway
+                cache = dict(self.cache, rows=list(self.cache['rows']))
+                self.load_data(lambda: build_saved_dataset(cache, 'changed'))
+        if conflicts:
+            self.resolve_conflicts(conflicts)
+        self.update_title()
+        self.schedule_sync(0)
+
+    def resolve_conflicts(self, conflicts):
+        # Someone else changed these rows after we last saw them. Either ours go
+        # in on top of theirs, or theirs replace ours here.
+        titles = read_rows(self.cache['header'], [entry['row'] for entry, _ in conflicts])['title'].tolist()
+        summary = "\n".join(f"- {title}" + ("" if current else " (deleted on the server)")
+                            for title, (_, current) in zip(titles[:CONFLICTS_SHOWN], conflicts))
+        if len(conflicts) > CONFLICTS_SHOWN:
+            summary += f"\n... and {len(conflicts) - CONFLICTS_SHOWN} more"
+        keep_mine = messagebox.askyesno(
+            "Conflict", f"{len(conflicts)} of your edits clash with changes someone else made on the server:\n\n"
+                        f"{summary}\n\nKeep your versions? Yes overwrites theirs, No keeps theirs.")
+
+        theirs = []
+        for entry, current in conflicts:
+            if current is None:
+                continue  # Deleted there, nothing left to overwrite
+            if keep_mine:
+                self.journal.rebase(line_id(current), current, entry['row'])
+            else:
+                theirs.append(current)
+        if theirs and not self.patch_rows([], theirs):
+            self.sync_with_server()
+
     def refresh_data(self):
-        self.tree.delete(*self.tree.get_children())
-        self.load_data()
-        self.populate_tree()
+        self.load_data()  # Repopulates the tree itself once the data is in
         
     def toggle_end_date(self):
         if self.has_end_date.get():
@@ -571,19 +1260,56 @@ class CSVApp:
             self.end_date_var.set('')
             
     def check_and_update(self):
-        update_available, download_url, changelog = is_update_available(currentVersion)
-        if update_available:
-            answer = messagebox.askyesno("Update Available", "An update is available. Do you want to download and install it?")
-            if answer:
-                download_success = download_update(download_url, changelog)  # Pass the download URL
-                if download_success:
-                    apply_update()
-                    messagebox.showinfo("Update Successful", "The application was updated successfully. Please restart the application to use the new version.")
-                    self.quit()
-        else:
-            messagebox.showinfo("No Update", "You are using the latest version.")
-            
+        # From the menu: the same check as at startup, but says so when there's nothing new
+        self.run_in_background(lambda: is_update_available(currentVersion),
+                               lambda result: self.on_update_checked(result, manual=True))
+
+    def offer_update(self, manifest):
+        if self.update_progress is not None:
+            return  # Already downloading
+        answer = messagebox.askyesno("Update Available", "An update is available. Do you want to download and install it?")
+        if not answer:
+            return
+
+        self.update_progress = (0, None)
+        self.update_window = tk.Toplevel(self.root)
+        self.update_window.title("Downloading Update")
+        self.update_label = ttk.Label(self.update_window, text="Starting download...")
+        self.update_label.pack(padx=10, pady=5)
+        self.update_bar = ttk.Progressbar(self.update_window, length=300, maximum=100)
+        self.update_bar.pack(padx=10, pady=10)
+
+        def progress(done, total):
+            self.update_progress = (done, total)  # Picked up on the Tk thread by show_update_progress
+        self.run_in_background(lambda: download_update(manifest, progress), self.on_update_downloaded)
+        self.show_update_progress()
+
+    def show_update_progress(self):
+        if self.update_progress is None:
+            return
+        done, total = self.update_progress
+        if self.update_window.winfo_exists():
+            if total:
+                self.update_bar['value'] = done * 100 / total
+                self.update_label.config(text=f"{done / 1e6:.1f} of {total / 1e6:.1f} MB")
+            else:
+                self.update_label.config(text=f"{done / 1e6:.1f} MB")
+        self.root.after(UPDATE_PROGRESS_MS, self.show_update_progress)
+
+    def on_update_downloaded(self, success):
+        self.update_progress = None
+        if self.update_window.winfo_exists():
+            self.update_window.destroy()
+        if not success:
+            messagebox.showerror("Update Failed", "The update could not be downloaded. Next time it carries on from where it stopped.")
+            return
+        messagebox.showinfo("Update Ready", "The update was downloaded and checked. The application will now restart to install it.")
+        apply_update()  # Exits if it worked
+        messagebox.showerror("Update Failed", "The update could not be installed.")
+
     def show_about(self):
+        import webbrowser
+        from PIL import Image, ImageTk
         about_win = tk.Toplevel(self.root)
         about_win.title("About")
         def resource_path(relative_path):
@@ -612,6 +1338,7 @@ class CSVApp:
 
         # Create and pack widgets for the version, copyright, and link to GitHub
         ttk.Label(about_win, text="Version: " + currentVersion).pack(pady=5)
+        ttk.Label(about_win, text=self.startup_report()).pack(pady=5)
         copyright = ttk.Label(about_win, text="©2023 Matthew Thomas Stevens Studios LLC", cursor="hand2", foreground="white", font="TkDefaultFont 10 underline")
         copyright.pack(pady=5)
         copyright.bind("<Button-1>", lambda e: webbrowser.open("https://www.matthewstevens.me"))
@@ -620,21 +1347,31 @@ class CSVApp:
         about_win.mainloop()
         
     def periodic_check_for_updates(self):
-        # Check for updates
-        update_available = self.check_for_updates_at_start()
-        
-        # Modify the hamburger menu button accordingly
-        self.update_menu_button_text(update_available)
+        # Check for updates in the background, the answer comes back in on_update_checked
+        self.run_in_background(lambda: is_update_available(currentVersion), self.on_update_checked)
         
         # Schedule the next check for 24 hours from now
         self.root.after(15*60*60*1000, self.periodic_check_for_updates)
         
+    def on_update_checked(self, result, manual=False):
+        self.record_startup('version check')
+        update_available, manifest = result or (False, {})
+
+        # Modify the hamburger menu button accordingly
+        self.update_menu_button_text(update_available)
+        if update_available:
+            self.offer_update(manifest)
+        elif manual:
+            messagebox.showinfo("No Update", "You are using the latest version.")
+
     def show_changelog(self):
         changelog_content = self.get_changelog()
 
         # If there's no changelog content (due to file not existing or any other error), simply return
         if not changelog_content:
             return
+        import webbrowser
+        from PIL import Image, ImageTk
 
         def resource_path(relative_path):
             try:
@@ -685,24 +1422,267 @@ class CSVApp:
             return None
         
         
-def download_update(download_url, changelog):
+class FilterScheduler:
+    # Runs filter computations on a worker thread so the Tk loop never blocks.
+    # Requests are coalesced with root.after, the worker only picks up the newest
+    # one, and results from anything older than the latest request are dropped.
+    # apply is called on the Tk thread with the result of the latest request.
+    def __init__(self, root, apply):
+        self.root = root
+        self.apply = apply
+        self.generation = 0
+        self.after_id = None
+        self.poll_id = None
+        self.pending = None  # (generation, compute) waiting for the worker
+        self.waiting = None  # Generation the Tk side is polling for
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.results = queue.Queue()
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def schedule(self, compute, delay=0):
+        # compute runs on the worker and must not touch any Tk widgets
+        self.cancel()
+        generation = self.generation
+        self.after_id = self.root.after(delay, lambda: self.submit(generation, compute))
+
+    def cancel(self):
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+        self.generation += 1
+
+    def submit(self, generation, compute):
+        self.after_id = None
+        with self.lock:
+            self.pending = (generation, compute)
+        self.waiting = generation
+        self.wakeup.set()
+        if self.poll_id is None:
+            self.poll()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                job = self.pending
+                self.pending = None
+                self.wakeup.clear()
+            if job is None:
+                continue
+
+            generation, compute = job
+            if generation != self.generation:
+                continue  # A newer request came in while this one was waiting
+            try:
+                result = compute()
+            except Exception as e:
+                print(f"Error filtering: {e}")
+                result = None
+            self.results.put((generation, result))
+
+    def poll(self):
+        self.poll_id = None
+        done = False
+        try:
+            while not self.results.empty():
+                generation, result = self.results.get_nowait()
+                if generation == self.generation:
+                    done = True
+                    if result is not None:
+                        self.apply(result)
+        except Exception as e:
+            print(f"Error showing filter result: {e}")
+        finally:
+            # Keep checking until the latest request has come back or was cancelled
+            if not done and self.waiting == self.generation:
+                self.poll_id = self.root.after(10, self.poll)
+
+
+class ChangeListener:
+    # Keeps the server's /events stream open on its own thread. Every change the
+    # server pushes is handed to on_change on the Tk thread, checked with
+    # root.after like the filter results. If the connection drops it reconnects
+    # with backoff. The server starts every connection with a hello carrying its
+    # version, handed to on_hello to catch up on anything missed in between.
+    def __init__(self, root, on_change, on_hello):
+        self.root = root
+        self.on_change = on_change
+        self.on_hello = on_hello
+        self.events = queue.Queue()
+
+    def start(self):
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+        self.root.after(EVENT_POLL_MS, self.poll)
+
+    def run(self):
+        delay = 1
+        while True:
+            try:
+                response = open_change_stream()
+                if response.status_code == 404:
+                    print("Error: server has no change stream, falling back to manual refresh")
+                    return
+                if response.status_code == 200:
+                    delay = 1
+                    for kind, change in read_changes(response):
+                        self.events.put((kind, change))
+                else:
+                    print(f"Error {response.status_code} opening change stream")
+                response.close()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Error in change stream: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, EVENT_RETRY_MAX)
+
+    def poll(self):
+        # One bad change mustn't stop the stream: log it and carry on with the rest
+        try:
+            while not self.events.empty():
+                kind, change = self.events.get_nowait()
+                try:
+                    if kind == 'change':
+                        self.on_change(change)
+                    else:
+                        self.on_hello(change)
+                except Exception as e:
+                    print(f"Error handling server {kind} {change}: {e}")
+        finally:
+            self.root.after(EVENT_POLL_MS, self.poll)
+
+
+def date_entry(parent, variable):
+    # tkcalendar waits for the first entry popup. babel.numbers is what it
+    # uses behind the scenes, PyInstaller only bundles it if it's imported here.
+    from tkcalendar import DateEntry
+    import babel.numbers
+    return DateEntry(parent, textvariable=variable, date_pattern='y-mm-dd')
+
+
+def download_file(url, path, on_progress=None):
+    # Streams url into path + '.part', carrying on from the end of an earlier
+    # try with a Range request. Returns the SHA-256 of the whole file. The .part
+    # file stays if the connection drops.
+    part = path + '.part'
+    digest = hashlib.sha256()
+    done = 0
+    if os.path.exists(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPDATE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                done += len(chunk)
+
+    # identity: the byte ranges have to be of the file itself, not a gzipped copy
+    request_headers = {'Accept-Encoding': 'identity'}
+    if done:
+        request_headers['Range'] = f"bytes={done}-"
+    with http_client.get(url, headers=request_headers, stream=True, timeout=UPDATE_TIMEOUT) as response:
+        if response.status_code == 416:
+            return digest.hexdigest()  # Nothing after what we have
+        if response.status_code == 206:
+            mode = 'ab'
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            total = int(total) if total.isdigit() else None
+        else:
+            response.raise_for_status()
+            # The server sent the whole file after all
+            digest = hashlib.sha256()
+            done = 0
+            mode = 'wb'
+            total = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=UPDATE_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                done += len(chunk)
+                if on_progress:
+                    on_progress(done, total)
+    return digest.hexdigest()
+
+
+def fetch_verified(url, path, sha256, on_progress=None):
+    # download_file with a few tries. The file only gets its real name once its hash matches.
+    part = path + '.part'
+    for attempt in range(UPDATE_ATTEMPTS):
+        resumed = os.path.exists(part)
+        try:
+            digest = download_file(url, path, on_progress)
+        except requests.RequestException as e:
+            print(f"Error downloading {url} (try {attempt + 1}): {e}")
+            continue
+        if digest == sha256.lower():
+            os.replace(part, path)
+            return True
+        print(f"Error downloading {url}: SHA-256 {digest} doesn't match {sha256}")
+        os.remove(part)
+        if not resumed:
+            return False
+        # What we had may be from another version, one more go from nothing
+    return False
+
+
+def patch_current_exe(patch, sha256, on_progress=None):
+    # Builds the new exe from the running one and a bsdiff4 patch, a fraction of the download
+    try:
+        import bsdiff4
+    except ImportError:
+        return False  # Without it updates are always the whole exe
+    if not getattr(sys, 'frozen', False):
+        return False  # Run from source there's no exe to patch
+    patch_file = UPDATE_FILE + '.patch'
+    if not fetch_verified(patch['url'], patch_file, patch['sha256'], on_progress):
+        return False
+    with open(sys.executable, 'rb') as f:
+        current = f.read()
+    with open(patch_file, 'rb') as f:
+        new = bsdiff4.patch(current, f.read())
+    os.remove(patch_file)
+    if hashlib.sha256(new).hexdigest() != sha256:
+        print("Error applying update patch: the result doesn't match the SHA-256 of the new version")
+        return False
+    with open(UPDATE_FILE, 'wb') as f:
+        f.write(new)
+    return True
+
+
+def download_update(manifest, on_progress=None):
+    # Gets the new version as UPDATE_FILE, patched from this one if the manifest
+    # has a patch for it, the whole exe otherwise. Nothing is kept unless its
+    # SHA-256 matches the manifest. Runs on a worker thread.
     try:
-        # Download the .exe file
-        response = requests.get(download_url, stream=True)
-        with open('latest_app.exe', 'wb') as file:
-            for chunk in response.iter_content(chunk_size=1024):
-                file.write(chunk)
-        if changelog:
+        sha256 = manifest.get('sha256', '').lower()
+        if not sha256:
+            print("Error downloading update: the manifest has no sha256 to check it against")
+            return False
+
+        downloaded = False
+        patch = manifest.get('patches', {}).get(currentVersion)
+        if patch:
+            try:
+                downloaded = patch_current_exe(patch, sha256, on_progress)
+            except Exception as e:
+                print(f"Error applying update patch, getting the whole file instead: {e}")
+        if not downloaded:
+            downloaded = fetch_verified(manifest.get('download_url', ""), UPDATE_FILE, sha256, on_progress)
+
+        changelog = manifest.get('changelog', "")
+        if downloaded and changelog:
             with open('changelog.txt', 'w') as f:
                 f.write(changelog)
-        
-        return True
+        return downloaded
     except Exception as e:
         print(f"Error downloading update: {e}")
         return False
 
     
 def apply_update():
+    import subprocess
     try:
         # Rename the downloaded exe to a temporary name
         os.rename('latest_app.exe', 'update_temp.exe')
@@ -731,27 +1711,36 @@ del update_helper.bat
         return False
 
             
+def parse_version(text):
+    # Semantic versioning order as a tuple: 1.10.0 > 1.9.0, and a pre-release
+    # comes before its release (2.0.0-beta.2 < 2.0.0-beta.10 < 2.0.0). None if
+    # text isn't a version.
+    match = VERSION_PATTERN.match(text.strip())
+    if not match:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    release = (int(major), int(minor or 0), int(patch or 0))
+    if not prerelease:
+        return release + ((1,),)
+    # Numeric identifiers compare as numbers and before alphanumeric ones
+    identifiers = tuple((0, int(part), '') if part.isdigit() else (1, 0, part) for part in prerelease.split('.'))
+    return release + ((0,) + identifiers,)
+
+
 def is_update_available(current_version):
+    # Returns (newer version on the server, its manifest)
     try:
-        # Generate headers with the token
-        headers = {
-            'User-Agent': 'targetLookUp/1.0'
-        }
-        
-        response = requests.get(SERVER_URL, headers=headers)
-        data = response.json()
-        
-        latest_version = data.get('version', "")
-        #check to see if latest_version has a V in it and if so remove it before checking if it is greater than current_version
-        if latest_version[0] == 'V':
-            latest_version = latest_version[1:]
-        download_url = data.get('download_url', "")
-        changelog = data.get('changelog', "")
-        
-        return latest_version > current_version, download_url, changelog
+        response = http_client.get(SERVER_URL)
+        manifest = response.json()
+        latest = parse_version(manifest.get('version', ""))
+        current = parse_version(current_version)
+        if latest is None or current is None:
+            print(f"Error checking for update: can't compare versions {manifest.get('version')!r} and {current_version!r}")
+            return False, manifest
+        return latest > current, manifest
     except Exception as e:
         print(f"Error checking for update: {e}")
-        return False, ""
+        return False, {}
 
 
 if __name__ == "__main__":
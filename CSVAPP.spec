@@ -9,7 +9,7 @@ block_cipher = None
 
 
 a = Analysis(
-    ['CSVAPP.py', 'urlFileChecker.py'],
+    ['CSVAPP.py', 'urlFileChecker.py', 'targetCore.py', 'importTimer.py'],
     pathex=[],
     binaries=[],
     datas=datas,
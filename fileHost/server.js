@@ -1,53 +1,207 @@
 const express = require('express');
 const bodyParser = require('body-parser');
 const cors = require('cors');
-const fs = require('fs');
-const path = require('path');
+const zlib = require('zlib');
 const multer = require('multer');  // Add multer
+const { Store, splitCsv, diffRows, collectChanges, rowId } = require('./storage');
 
 const app = express();
 
-const BACKUP_DIR = './backups/';
-const TARGET_FILE = './target.csv';
+// target.csv lives in memory, writes go to an append-only log (see storage.js)
+const store = new Store(__dirname);
 
 // Middleware
 app.use(cors());
-app.use(bodyParser.json());
+app.use(bodyParser.json({ limit: '20mb' }));  // Bulk imports send thousands of rows at once
 
 const storage = multer.memoryStorage();  // Store the file data in memory
 const upload = multer({ storage: storage });
 
+// Versioning for conditional downloads and row-level deltas.
+// The epoch changes on every restart so clients holding a version from a
+// previous run fall back to a full download instead of a bad delta.
+const DATA_EPOCH = Date.now().toString(36);
+const MAX_CHANGE_LOG = 200;  // How many edits worth of deltas we keep around
+let dataVersion = 1;
+let lastModified = new Date();
+const changeLog = [];  // [{ version, added: [lines], removed: [lines] }]
 
+function currentVersionTag() {
+    return `${DATA_EPOCH}-${dataVersion}`;
+}
+
+function recordChange(oldText, newText) {
+    const oldCsv = splitCsv(oldText);
+    const newCsv = splitCsv(newText);
 
-function renameAndBackup() {
-    if (fs.existsSync(TARGET_FILE)) {
-        const dateStr = new Date().toISOString().replace(/[:.]/g, "-");
-        const backupName = `backup-${dateStr}.csv`;
+    // A changed header means the rows can't be patched, so forget the history
+    if (oldCsv.header !== newCsv.header) {
+        const previous = currentVersionTag();
+        dataVersion += 1;
+        lastModified = new Date();
+        changeLog.length = 0;
+        broadcast('change', { previous: previous, version: currentVersionTag(), reset: true });
+        return;
+    }
 
-        fs.renameSync(TARGET_FILE, path.join(BACKUP_DIR, backupName));
+    pushChange(diffRows(oldCsv.rows, newCsv.rows));
+}
 
-        // Check and delete backups if there are more than five
-        const backups = fs.readdirSync(BACKUP_DIR).sort((a, b) => {
-            return fs.statSync(path.join(BACKUP_DIR, b)).mtime - fs.statSync(path.join(BACKUP_DIR, a)).mtime;
-        });
+// Call after the store has the change
+function pushChange(change) {
+    const previous = currentVersionTag();
+    dataVersion += 1;
+    lastModified = new Date();
 
-        while (backups.length > 5) {
-            const oldestBackup = backups.pop();
-            fs.unlinkSync(path.join(BACKUP_DIR, oldestBackup));
-        }
+    change.version = dataVersion;
+    changeLog.push(change);
+    while (changeLog.length > MAX_CHANGE_LOG) {
+        changeLog.shift();
+    }
+
+    broadcast('change', {
+        previous: previous,
+        version: currentVersionTag(),
+        header: store.header,
+        added: change.added,
+        removed: change.removed
+    });
+}
+
+// Clients listening on /events. Every change goes out to them as it happens,
+// with the rows in it, so they don't have to poll for updates.
+const HEARTBEAT_MS = 20000;  // Keeps idle connections and proxies from timing out
+const subscribers = new Set();
+
+function broadcast(event, data) {
+    const message = `event: ${event}\ndata: ${JSON.stringify(data)}\n\n`;
+    for (const res of subscribers) {
+        res.write(message);
+    }
+}
+
+setInterval(() => {
+    for (const res of subscribers) {
+        res.write(': ping\n\n');
     }
+}, HEARTBEAT_MS).unref();
+
+app.get('/events', validateToken, (req, res) => {
+    res.set({
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive'
+    });
+    res.flushHeaders();
+    res.write(`event: hello\ndata: ${JSON.stringify({ version: currentVersionTag() })}\n\n`);
+
+    subscribers.add(res);
+    req.on('close', () => subscribers.delete(res));
+});
+
+function setVersionHeaders(res) {
+    res.set('ETag', `"${currentVersionTag()}"`);
+    res.set('Last-Modified', lastModified.toUTCString());
+    res.set('X-Data-Version', currentVersionTag());
 }
 
+
 app.get('/download', validateToken, (req, res) => {
-    const filePath = path.join(__dirname, 'target.csv');
+    if (!store.header) {
+        return res.status(404).send('File not found');
+    }
 
-    if (fs.existsSync(filePath)) {
-        res.sendFile(filePath);
-    } else {
-        res.status(404).send('File not found');
+    setVersionHeaders(res);
+    if (req.fresh) {
+        return res.status(304).end();
     }
+    sendCompressed(req, res, store.text(), true);
 });
 
+// Rows added/removed since the version the client already has
+app.get('/delta', validateToken, (req, res) => {
+    const since = String(req.query.since || '');
+    const [epoch, versionStr] = since.split('-');
+    const sinceVersion = parseInt(versionStr, 10);
+
+    setVersionHeaders(res);
+    if (since === currentVersionTag()) {
+        return res.status(304).end();
+    }
+
+    // Unknown epoch or a version older than our history: client must do a full download
+    const oldest = changeLog.length ? changeLog[0].version - 1 : dataVersion;
+    if (epoch !== DATA_EPOCH || isNaN(sinceVersion) || sinceVersion < oldest || sinceVersion > dataVersion) {
+        return res.status(410).json({ error: 'Version not available, download the full file' });
+    }
+
+    const counts = new Map();
+    for (const change of changeLog) {
+        if (change.version <= sinceVersion) continue;
+        for (const row of change.removed) counts.set(row, (counts.get(row) || 0) - 1);
+        for (const row of change.added) counts.set(row, (counts.get(row) || 0) + 1);
+    }
+    const merged = collectChanges(counts);
+
+    res.json({
+        version: currentVersionTag(),
+        header: store.header,
+        added: merged.added,
+        removed: merged.removed
+    });
+});
+
+// The async zlib calls run on the thread pool so a big file doesn't hold up other requests
+function compress(text, encoding) {
+    return new Promise((resolve, reject) => {
+        const done = (err, body) => err ? reject(err) : resolve(body);
+        if (encoding === 'br') {
+            zlib.brotliCompress(text, { params: { [zlib.constants.BROTLI_PARAM_QUALITY]: 5 } }, done);
+        } else {
+            zlib.gzip(text, done);
+        }
+    });
+}
+
+// Compressed copies of the current file, made once per version and shared by
+// every download until the next change
+let compressedVersion = null;
+let compressedBodies = {};
+
+function compressedCurrent(encoding) {
+    const version = currentVersionTag();
+    if (compressedVersion !== version) {
+        compressedVersion = version;
+        compressedBodies = {};
+    }
+    if (!compressedBodies[encoding]) {
+        const bodies = compressedBodies;
+        bodies[encoding] = compress(store.text(), encoding);
+        bodies[encoding].catch(() => delete bodies[encoding]);  // Try again next time
+    }
+    return compressedBodies[encoding];
+}
+
+// Brotli or gzip when the client accepts it. current means text is the current
+// file, so the cached compressed copy can be used.
+function sendCompressed(req, res, text, current) {
+    const encoding = req.acceptsEncodings('br', 'gzip', 'identity');
+    res.set('Vary', 'Accept-Encoding');
+    res.set('Content-Type', 'text/csv; charset=UTF-8');
+    if (encoding !== 'br' && encoding !== 'gzip') {
+        return res.send(text);
+    }
+
+    const body = current ? compressedCurrent(encoding) : compress(text, encoding);
+    body.then(data => {
+        res.set('Content-Encoding', encoding);
+        res.send(data);
+    }).catch(err => {
+        console.log("DEBUG: Failed to compress target file.", err);
+        res.status(500).send('Compression failed');
+    });
+}
+
 function validateToken(req, res, next) {
     const authHeader = req.headers['authorization'];
 
@@ -66,14 +220,208 @@ app.post('/upload', upload.single('file'), (req, res) => {
     }
 
     const fileData = req.file.buffer.toString();
+    const oldData = store.text();
+    const saved = store.replace(fileData);
+    recordChange(oldData, store.text());  // With the ids the store gave new rows
+    const version = currentVersionTag();
+
+    saved
+        .then(() => res.status(200).json({ success: true, version: version }))
+        .catch(() => res.status(500).json({ error: 'Could not save file' }));
+});
 
-    renameAndBackup();
 
-    fs.writeFileSync(TARGET_FILE, fileData);
-    res.status(200).json({ success: true });
+// History. Backups are kept as row level diffs (see storage.js), so any point
+// in the retention window can be looked at or restored.
+function parseTime(value) {
+    const time = Date.parse(String(value || ''));
+    return isNaN(time) ? null : time;
+}
+
+app.get('/history', validateToken, (req, res) => {
+    store.history()
+        .then(history => res.json(history))
+        .catch(() => res.status(500).json({ error: 'Could not read history' }));
+});
+
+// The file as it was at ?time=<ISO date>
+app.get('/history/at', validateToken, (req, res) => {
+    const time = parseTime(req.query.time);
+    if (time === null) {
+        return res.status(400).json({ error: 'Missing or invalid time' });
+    }
+
+    store.stateAt(time).then(state => {
+        if (state === null) {
+            return res.status(404).json({ error: 'History does not go back that far' });
+        }
+        sendCompressed(req, res, [state.header].concat(state.rows).join('\n') + '\n');
+    }).catch(() => res.status(500).json({ error: 'Could not read history' }));
+});
+
+// Puts the file back the way it was at { time }. This is a change like any
+// other, so it can be undone the same way.
+app.post('/history/restore', validateToken, (req, res) => {
+    const time = parseTime(req.body.time);
+    if (time === null) {
+        return res.status(400).json({ error: 'Missing or invalid time' });
+    }
+
+    store.stateAt(time).then(state => {
+        if (state === null) {
+            return res.status(404).json({ error: 'History does not go back that far' });
+        }
+        const fileData = [state.header].concat(state.rows).join('\n') + '\n';
+        const oldData = store.text();
+        const saved = store.replace(fileData);
+        recordChange(oldData, store.text());
+        const version = currentVersionTag();
+        return saved.then(() => res.status(200).json({ success: true, version: version }));
+    }).catch(() => res.status(500).json({ error: 'Could not restore' }));
+});
+
+
+// Row level edits. Rows are found by their id (the first column, given out by
+// the store), and an edit only goes through if the row still looks the way the
+// client saw it. Otherwise someone else changed it first and the client gets a
+// 409 instead of overwriting them. New rows get their id from the server and
+// the response has the row as stored.
+// The change is applied in memory straight away and the response is sent once
+// it has been appended to the change log.
+function applyRowChange(req, res, oldRow, newRow) {
+    const previous = currentVersionTag();
+
+    if (req.body.header !== undefined && req.body.header !== store.header) {
+        return res.status(409).json({ error: 'Column layout changed, refresh and try again', version: previous });
+    }
+
+    const id = String(req.body.id);
+    const op = oldRow === null ? { op: 'add', row: newRow }
+        : newRow === null ? { op: 'delete', id: id, old: oldRow }
+        : { op: 'update', id: id, old: oldRow, row: newRow };
+    const saved = store.apply(op);
+    if (saved === null) {
+        // If nothing happened since the client's version the row never existed
+        const error = req.body.version === previous ? 'Row not found' : 'Row was changed by someone else';
+        return res.status(409).json({ error: error, version: previous });
+    }
+
+    const row = newRow !== null ? op.row : null;
+    pushChange({ added: row !== null ? [row] : [], removed: oldRow !== null ? [oldRow] : [] });
+    const version = currentVersionTag();
+    saved
+        .then(() => res.status(200).json({
+            success: true, previous: previous, version: version, id: row !== null ? rowId(row) : id, row: row
+        }))
+        .catch(() => res.status(500).json({ error: 'Could not save change', version: version }));
+}
+
+function isRow(value) {
+    return typeof value === 'string' && value.length > 0 && !/[\r\n]/.test(value);
+}
+
+function isId(value) {
+    return /^\d+$/.test(String(value));
+}
+
+app.post('/rows', validateToken, (req, res) => {
+    if (!isRow(req.body.row)) {
+        return res.status(400).json({ error: 'Missing row' });
+    }
+    applyRowChange(req, res, null, req.body.row);
+});
+
+app.put('/rows', validateToken, (req, res) => {
+    if (!isId(req.body.id) || !isRow(req.body.old) || !isRow(req.body.row)) {
+        return res.status(400).json({ error: 'Missing row or id' });
+    }
+    applyRowChange(req, res, req.body.old, req.body.row);
+});
+
+// Bulk import: all rows are added with one log write and one change
+app.post('/rows/batch', validateToken, (req, res) => {
+    const rows = req.body.rows;
+    if (!Array.isArray(rows) || rows.length === 0 || !rows.every(isRow)) {
+        return res.status(400).json({ error: 'Missing or invalid rows' });
+    }
+
+    const previous = currentVersionTag();
+    if (req.body.header !== undefined && req.body.header !== store.header) {
+        return res.status(409).json({ error: 'Column layout changed, refresh and try again', version: previous });
+    }
+
+    const op = { op: 'addRows', rows: rows };
+    const saved = store.apply(op);
+    pushChange({ added: op.rows.slice(), removed: [] });
+    const version = currentVersionTag();
+    saved
+        .then(() => res.status(200).json({
+            success: true, previous: previous, version: version, added: op.rows.length, ids: op.rows.map(rowId)
+        }))
+        .catch(() => res.status(500).json({ error: 'Could not save rows', version: version }));
+});
+
+// Edits a client queued up while it was offline or busy, applied in order in
+// one request. Each one goes through or fails on its own, a conflict comes
+// back with the row as it is now so the client can show it instead of
+// overwriting someone else's change.
+app.post('/rows/sync', validateToken, (req, res) => {
+    const ops = req.body.ops;
+    if (!Array.isArray(ops) || ops.length === 0) {
+        return res.status(400).json({ error: 'Missing edits' });
+    }
+
+    const previous = currentVersionTag();
+    if (req.body.header !== undefined && req.body.header !== store.header) {
+        return res.status(409).json({ error: 'Column layout changed, refresh and try again', version: previous });
+    }
+
+    const counts = new Map();
+    const saves = [];
+    const results = ops.map(entry => {
+        let op;
+        if (entry.op === 'add' && isRow(entry.row)) {
+            op = { op: 'add', row: entry.row };
+        } else if (entry.op === 'update' && isId(entry.id) && isRow(entry.old) && isRow(entry.row)) {
+            op = { op: 'update', id: String(entry.id), old: entry.old, row: entry.row };
+        } else {
+            return { status: 'invalid' };
+        }
+
+        const saved = store.apply(op);
+        if (saved === null) {
+            return { status: 'conflict', current: store.row(op.id) };
+        }
+        saves.push(saved);
+        if (op.old !== undefined) {
+            counts.set(op.old, (counts.get(op.old) || 0) - 1);
+        }
+        counts.set(op.row, (counts.get(op.row) || 0) + 1);
+        return { status: 'ok', id: rowId(op.row), row: op.row };
+    });
+
+    if (saves.length) {
+        pushChange(collectChanges(counts));  // Rows edited twice in the batch only show up once
+    }
+    const version = currentVersionTag();
+    Promise.all(saves)
+        .then(() => res.status(200).json({ success: true, previous: previous, version: version, results: results }))
+        .catch(() => res.status(500).json({ error: 'Could not save changes', version: version }));
+});
+
+app.delete('/rows', validateToken, (req, res) => {
+    if (!isId(req.body.id) || !isRow(req.body.row)) {
+        return res.status(400).json({ error: 'Missing row or id' });
+    }
+    applyRowChange(req, res, req.body.row, null);
 });
 
 
-app.listen(3000, () => {
-    console.log('Server started on port 3000');
+store.load().then(() => {
+    app.listen(3000, () => {
+        console.log('Server started on port 3000');
+    });
+}).catch(err => {
+    console.log("DEBUG: Could not load target file.", err);
+    process.exit(1);
 });
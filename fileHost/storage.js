@@ -0,0 +1,485 @@
+const fs = require('fs');
+const fsp = fs.promises;
+const path = require('path');
+
+// Storage for target.csv.
+//
+// The current data lives in memory. On disk it is a snapshot (target.csv) plus
+// an append-only log of row operations written on top of it (changes.log), so a
+// row edit only appends one line. Every COMPACT_EVERY operations, or when a whole
+// file is uploaded, the memory copy is written out as a new snapshot:
+//
+//   1. write target.csv.tmp and fsync it
+//   2. rename it to target.csv.next, from here on the new snapshot is complete
+//   3. move changes.log into backups/ as log-<time>.log
+//   4. rename target.csv.next to target.csv
+//
+// A crash at any point leaves either the old snapshot + log or a complete
+// target.csv.next, and load() finishes whatever was interrupted.
+// All disk writes go through one queue so they happen in the order the
+// changes were made in memory.
+//
+// History is kept as row level diffs rather than full copies. backups/ holds
+// a full base-<time>.csv every BASE_EVERY_DAYS (a hard link to that snapshot,
+// so it costs nothing until target.csv moves on) and every log segment in
+// between. The data at any time is the newest base before it with the
+// segments after it replayed up to that time.
+//
+// Every row has an id, the first column, handed out here and never reused.
+// Rows are kept in a Map by id in file order, so finding, changing or
+// deleting one is a lookup however big the file is. A file without ids gets
+// them when it is loaded or uploaded.
+
+const COMPACT_EVERY = 200;  // Row operations in the log before it is folded into a snapshot
+const BASE_EVERY_DAYS = parseInt(process.env.BACKUP_BASE_EVERY_DAYS, 10) || 7;
+const RETENTION_DAYS = parseInt(process.env.BACKUP_RETENTION_DAYS, 10) || 90;
+const DAY = 24 * 60 * 60 * 1000;
+const ID_COLUMN = 'id';
+
+function splitCsv(text) {
+    const lines = text.split(/\r?\n/);
+    const header = lines.shift() || '';
+    return { header: header, rows: lines.filter(line => line.length > 0) };
+}
+
+// Multiset difference of two row lists, so duplicate rows are handled correctly
+function diffRows(oldRows, newRows) {
+    const counts = new Map();
+    for (const row of oldRows) {
+        counts.set(row, (counts.get(row) || 0) - 1);
+    }
+    for (const row of newRows) {
+        counts.set(row, (counts.get(row) || 0) + 1);
+    }
+    return collectChanges(counts);
+}
+
+function hasIds(header) {
+    return header === ID_COLUMN || header.startsWith(ID_COLUMN + ',');
+}
+
+function rowId(row) {
+    const comma = row.indexOf(',');
+    return comma === -1 ? row : row.slice(0, comma);
+}
+
+function withId(row, id) {
+    const comma = row.indexOf(',');
+    return comma === -1 ? String(id) : id + row.slice(comma);
+}
+
+// Rows from history written before there were ids get a made-up key
+let legacyKeys = 0;
+
+function rowKey(state, row) {
+    return hasIds(state.header) ? rowId(row) : `\0${legacyKeys++}`;
+}
+
+function rowMap(state, rows) {
+    const map = new Map();
+    for (const row of rows) {
+        map.set(rowKey(state, row), row);
+    }
+    return map;
+}
+
+function collectChanges(counts) {
+    const added = [];
+    const removed = [];
+    for (const [row, count] of counts) {
+        for (let i = 0; i < count; i++) added.push(row);
+        for (let i = 0; i > count; i--) removed.push(row);
+    }
+    return { added: added, removed: removed };
+}
+
+// op is { op: 'add', row }, { op: 'update', id, old, row }, { op: 'delete', id, old },
+// { op: 'addRows', rows } for a bulk import
+// or { op: 'replace', header, removed, added } for a whole file upload.
+// Ops logged before there were ids have no id and find their row by content.
+// state is anything with header and rows (a Map, see rowMap), the Store itself or a restored copy.
+// Returns false without changing anything when the old row isn't there.
+function applyOp(state, op) {
+    if (op.op === 'add') {
+        state.rows.set(rowKey(state, op.row), op.row);
+        return true;
+    }
+
+    if (op.op === 'addRows') {
+        for (const row of op.rows) {
+            state.rows.set(rowKey(state, row), row);
+        }
+        return true;
+    }
+
+    if (op.op === 'replace') {
+        const removing = new Map();
+        for (const row of op.removed) {
+            removing.set(row, (removing.get(row) || 0) + 1);
+        }
+        const kept = [];
+        for (const row of state.rows.values()) {
+            const count = removing.get(row);
+            if (count) {
+                removing.set(row, count - 1);
+            } else {
+                kept.push(row);
+            }
+        }
+        state.header = op.header;
+        state.rows = rowMap(state, kept.concat(op.added));
+        return true;
+    }
+
+    let key;
+    if (op.id !== undefined) {
+        key = state.rows.get(op.id) === op.old ? op.id : undefined;
+    } else {
+        for (const [candidate, row] of state.rows) {
+            if (row === op.old) {
+                key = candidate;
+                break;
+            }
+        }
+    }
+    if (key === undefined) {
+        return false;
+    }
+    if (op.op === 'update') {
+        state.rows.set(key, op.row);  // Keeps the row where it was
+    } else {
+        state.rows.delete(key);
+    }
+    return true;
+}
+
+// Every complete entry ends in a newline, so anything after the last one is a
+// write that was cut off by a crash. length is how much of the text is good.
+function parseLog(text) {
+    const entries = [];
+    let start = 0;
+    let end;
+    while ((end = text.indexOf('\n', start)) !== -1) {
+        try {
+            entries.push(JSON.parse(text.slice(start, end)));
+        } catch (err) {
+            break;
+        }
+        start = end + 1;
+    }
+    return { entries: entries, length: start };
+}
+
+function toStamp(time) {
+    return new Date(time).toISOString().replace(/[:.]/g, '-');
+}
+
+function fromStamp(stamp) {
+    const match = /^(\d{4}-\d\d-\d\d)T(\d\d)-(\d\d)-(\d\d)-(\d{3})Z$/.exec(stamp);
+    return match ? Date.parse(`${match[1]}T${match[2]}:${match[3]}:${match[4]}.${match[5]}Z`) : NaN;
+}
+
+async function exists(file) {
+    try {
+        await fsp.access(file);
+        return true;
+    } catch (err) {
+        return false;
+    }
+}
+
+async function moveIfExists(from, to) {
+    if (await exists(from)) {
+        await fsp.rename(from, to);
+    }
+}
+
+class Store {
+    constructor(dir) {
+        this.targetFile = path.join(dir, 'target.csv');
+        this.tempFile = path.join(dir, 'target.csv.tmp');
+        this.nextFile = path.join(dir, 'target.csv.next');
+        this.logFile = path.join(dir, 'changes.log');
+        this.backupDir = path.join(dir, 'backups');
+
+        this.header = '';
+        this.rows = new Map();
+        this.nextId = 1;
+        this.logLength = 0;
+        this.cachedText = null;
+        this.queue = Promise.resolve();
+    }
+
+    async load() {
+        await fsp.mkdir(this.backupDir, { recursive: true });
+
+        // An interrupted compaction: the new snapshot is complete, finish moving files
+        if (await exists(this.nextFile)) {
+            await this.finishCompaction(toStamp(Date.now()));
+        }
+        // A snapshot that was still being written is useless
+        if (await exists(this.tempFile)) {
+            await fsp.unlink(this.tempFile);
+        }
+
+        if (await exists(this.targetFile)) {
+            const csv = splitCsv(await fsp.readFile(this.targetFile, 'utf8'));
+            this.header = csv.header;
+            this.rows = rowMap(this, csv.rows);
+
+            // History has to start somewhere
+            const backups = await this.listBackups();
+            if (!backups.bases.length) {
+                await this.saveBase(toStamp((await fsp.stat(this.targetFile)).mtime));
+            }
+            if (backups.legacy.length) {
+                console.log(`DEBUG: Keeping ${backups.legacy.length} old backup-*.csv files, they are never pruned.`);
+            }
+        }
+
+        if (await exists(this.logFile)) {
+            const log = await fsp.readFile(this.logFile, 'utf8');
+            const parsed = parseLog(log);
+            for (const op of parsed.entries) {
+                applyOp(this, op);
+            }
+            this.logLength = parsed.entries.length;
+
+            if (parsed.length < log.length) {
+                // Cut it off, or the next append would be glued onto it
+                console.log("DEBUG: Dropping incomplete change log entry.");
+                await fsp.truncate(this.logFile, Buffer.byteLength(log.slice(0, parsed.length)));
+            }
+        }
+        this.cachedText = null;
+
+        for (const id of this.rows.keys()) {
+            if (/^\d+$/.test(id)) {
+                this.nextId = Math.max(this.nextId, parseInt(id, 10) + 1);
+            }
+        }
+        if (this.header && !hasIds(this.header)) {
+            console.log("DEBUG: Giving every row an id.");
+            await this.replace(this.text());
+        }
+    }
+
+    text() {
+        if (this.cachedText === null) {
+            this.cachedText = [this.header].concat(Array.from(this.rows.values())).join('\n') + '\n';
+        }
+        return this.cachedText;
+    }
+
+    // The row with this id as stored, or null
+    row(id) {
+        const row = this.rows.get(String(id));
+        return row === undefined ? null : row;
+    }
+
+    // Applies op in memory right away. Returns null when the old row is missing,
+    // otherwise a promise that resolves once the op is in the log. New rows get
+    // their id here, whatever the client put in that column, so op.row /
+    // op.rows are the rows as stored afterwards.
+    apply(op) {
+        if (op.op === 'add') {
+            op.row = withId(op.row, this.nextId++);
+        } else if (op.op === 'addRows') {
+            op.rows = op.rows.map(row => withId(row, this.nextId++));
+        } else if (op.op === 'update' && op.id !== undefined) {
+            op.row = withId(op.row, op.id);  // An edit can't move a row to another id
+        }
+        if (!applyOp(this, op)) {
+            return null;
+        }
+        this.cachedText = null;
+
+        const saved = this.appendLog(op);
+        if (this.logLength >= COMPACT_EVERY) {
+            this.compact();
+        }
+        return saved;
+    }
+
+    // Replaces everything, e.g. for a whole file upload. Only the difference goes
+    // into the history, the new snapshot keeps the uploaded order. Rows keep
+    // the ids they come with, rows without one (or with one already used
+    // further up) get a new one.
+    replace(text) {
+        const csv = this.withIds(splitCsv(text));
+        const change = diffRows(Array.from(this.rows.values()), csv.rows);
+        this.appendLog({ op: 'replace', header: csv.header, removed: change.removed, added: change.added });
+
+        this.header = csv.header;
+        this.rows = rowMap(this, csv.rows);
+        this.cachedText = null;
+        return this.compact();
+    }
+
+    withIds(csv) {
+        let rows = csv.rows;
+        let header = csv.header;
+        if (!hasIds(header)) {
+            header = header ? `${ID_COLUMN},${header}` : ID_COLUMN;
+            rows = rows.map(row => ',' + row);
+        }
+        const seen = new Set();
+        rows = rows.map(row => {
+            let id = rowId(row);
+            if (!/^\d+$/.test(id) || seen.has(id)) {
+                id = String(this.nextId++);
+                row = withId(row, id);
+            }
+            this.nextId = Math.max(this.nextId, parseInt(id, 10) + 1);
+            seen.add(id);
+            return row;
+        });
+        return { header: header, rows: rows };
+    }
+
+    appendLog(op) {
+        this.logLength += 1;
+        const line = JSON.stringify(Object.assign({ at: Date.now() }, op)) + '\n';
+        return this.enqueue(() => fsp.appendFile(this.logFile, line));
+    }
+
+    compact() {
+        // Taken now, so it covers exactly the ops queued for the old log before it
+        const text = this.text();
+        this.logLength = 0;
+        return this.enqueue(() => this.writeSnapshot(text));
+    }
+
+    enqueue(task) {
+        const run = this.queue.then(task);
+        this.queue = run.catch(err => console.log("DEBUG: Storage task failed.", err));
+        return run;
+    }
+
+    async writeSnapshot(text) {
+        const stamp = toStamp(Date.now());
+
+        const handle = await fsp.open(this.tempFile, 'w');
+        try {
+            await handle.writeFile(text);
+            await handle.sync();
+        } finally {
+            await handle.close();
+        }
+        await fsp.rename(this.tempFile, this.nextFile);
+        await this.finishCompaction(stamp);
+    }
+
+    async finishCompaction(stamp) {
+        // The log is the diff from the previous snapshot to this one, so the
+        // previous snapshot itself doesn't need keeping
+        await moveIfExists(this.logFile, path.join(this.backupDir, `log-${stamp}.log`));
+        await fsp.rename(this.nextFile, this.targetFile);
+
+        const time = fromStamp(stamp);
+        const backups = await this.listBackups();
+        const lastBase = backups.bases.length ? backups.bases[backups.bases.length - 1].time : -Infinity;
+        if (time - lastBase >= BASE_EVERY_DAYS * DAY) {
+            await this.saveBase(stamp);
+        }
+        await this.pruneBackups(time);
+    }
+
+    async saveBase(stamp) {
+        const base = path.join(this.backupDir, `base-${stamp}.csv`);
+        try {
+            // target.csv is only ever replaced by a rename, so the link keeps this version
+            await fsp.link(this.targetFile, base);
+        } catch (err) {
+            await fsp.copyFile(this.targetFile, base);
+        }
+    }
+
+    // Everything in backups/ sorted oldest first. backup-*.csv are full copies
+    // from before history was kept as diffs. This store didn't write them, so
+    // they are left alone, deleting them is up to whoever runs the server.
+    async listBackups() {
+        const backups = { bases: [], segments: [], legacy: [] };
+        for (const name of await fsp.readdir(this.backupDir)) {
+            const match = /^(base|log|backup)-(.+)\.(csv|log)$/.exec(name);
+            const time = match ? fromStamp(match[2]) : NaN;
+            if (isNaN(time)) continue;
+
+            const entry = { time: time, file: path.join(this.backupDir, name) };
+            if (match[1] === 'base') backups.bases.push(entry);
+            else if (match[1] === 'log') backups.segments.push(entry);
+            else backups.legacy.push(entry);
+        }
+        for (const list of Object.values(backups)) {
+            list.sort((a, b) => a.time - b.time);
+        }
+        return backups;
+    }
+
+    async pruneBackups(now) {
+        const cutoff = now - RETENTION_DAYS * DAY;
+        const backups = await this.listBackups();
+        const expired = [];
+
+        // Only bases and log segments are pruned, see listBackups. The newest
+        // base from before the cutoff is where the oldest time we still cover
+        // starts, anything before it can go
+        const oldestNeeded = backups.bases.filter(base => base.time <= cutoff).pop();
+        if (oldestNeeded) {
+            expired.push(...backups.bases.filter(base => base.time < oldestNeeded.time));
+            expired.push(...backups.segments.filter(segment => segment.time <= oldestNeeded.time));
+        }
+
+        for (const entry of expired) {
+            await fsp.unlink(entry.file);
+        }
+    }
+
+    // { header, rows } as they were at time (ms), or null if history doesn't go back that far.
+    // Queued behind the writes so a compaction can't move a log while it's being read.
+    stateAt(time) {
+        return this.enqueue(async () => {
+            const backups = await this.listBackups();
+            const base = backups.bases.filter(entry => entry.time <= time).pop();
+            if (!base) {
+                return null;
+            }
+
+            const csv = splitCsv(await fsp.readFile(base.file, 'utf8'));
+            const state = { header: csv.header };
+            state.rows = rowMap(state, csv.rows);
+            const logs = backups.segments.filter(segment => segment.time > base.time).map(segment => segment.file);
+            logs.push(this.logFile);
+
+            for (const file of logs) {
+                if (!(await exists(file))) continue;
+                for (const op of parseLog(await fsp.readFile(file, 'utf8')).entries) {
+                    if ((op.at || 0) > time) {
+                        return { header: state.header, rows: Array.from(state.rows.values()) };
+                    }
+                    applyOp(state, op);
+                }
+            }
+            return { header: state.header, rows: Array.from(state.rows.values()) };
+        });
+    }
+
+    history() {
+        return this.enqueue(async () => {
+            const backups = await this.listBackups();
+            let bytes = 0;
+            for (const entry of backups.bases.concat(backups.segments)) {
+                bytes += (await fsp.stat(entry.file)).size;
+            }
+            return {
+                oldest: backups.bases.length ? new Date(backups.bases[0].time).toISOString() : null,
+                snapshots: backups.bases.length,
+                segments: backups.segments.length,
+                bytes: bytes,
+                retentionDays: RETENTION_DAYS
+            };
+        });
+    }
+}
+
+module.exports = { Store, splitCsv, diffRows, collectChanges, rowId };
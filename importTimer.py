@@ -0,0 +1,53 @@
+# Times imports the way python -X importtime does, but from inside the app, so
+# the packaged exe (no console, no python flags) can report where its startup
+# goes. Only stdlib here: it has to be imported before everything it times.
+import builtins
+import sys
+import threading
+import time
+
+
+class ImportTimer:
+    # Wraps __import__ while installed. For every module imported for the first
+    # time on the installing thread it keeps (own seconds, seconds including the
+    # modules it imported), like the self/cumulative columns of -X importtime.
+    # Relative imports count towards the package importing them.
+    def __init__(self):
+        self.times = {}
+        self.total = 0.0
+        self.stack = []  # Time spent in nested imports, per import in progress
+        self.thread = threading.get_ident()
+        self.original = builtins.__import__
+
+    def install(self):
+        builtins.__import__ = self.timed_import
+        return self
+
+    def uninstall(self):
+        builtins.__import__ = self.original
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules or threading.get_ident() != self.thread:
+            return self.original(name, globals, locals, fromlist, level)
+        start = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            seconds = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += seconds
+            else:
+                self.total += seconds
+            self.times[name] = (seconds - nested, seconds)
+
+    def slowest(self, limit=10):
+        # [(module, own seconds, cumulative seconds)], most cumulative first
+        rows = sorted(self.times.items(), key=lambda item: item[1][1], reverse=True)
+        return [(name, own, cumulative) for name, (own, cumulative) in rows[:limit]]
+
+    def report(self, limit=10):
+        lines = [f"{name}: {cumulative * 1000:.0f} ms ({own * 1000:.0f} ms own)"
+                 for name, own, cumulative in self.slowest(limit)]
+        return f"Imports {self.total * 1000:.0f} ms, slowest:\n" + "\n".join(lines)
@@ -0,0 +1,264 @@
+# Command line access to the activity data, no window needed.
+#
+#   python targetCLI.py query --search foo --live True      matching rows as CSV
+#   python targetCLI.py query --url example.com/page --live True   live activities on a page
+#   python targetCLI.py query --live True --sort "end date" live activities, soonest ending first
+#   python targetCLI.py overlaps                            live activities sharing a page per environment
+#   python targetCLI.py export target.csv                   everything to a file (.csv or .json)
+#   python targetCLI.py import new.csv                      check and add the rows in a file (.csv or .json)
+#   python targetCLI.py import --replace target.csv         replace the server's file
+#   python targetCLI.py bench --repeat 5                    time fetch, parse and queries
+#   python targetCLI.py check-links                         check every URL, exit code 1 if any is broken
+#   python targetCLI.py check-links --file test.csv         the same for a local file, e.g. one pointing
+#                                                           at a stub server (python -m http.server)
+#   python targetCLI.py startup --repeat 5                  time the app's cold start, exit code 1 if
+#                                                           over budget
+#
+# Uses the same local cache as the app unless --no-cache is given.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from targetCore import (
+    DISPLAY_COLUMNS, ID_COLUMN, LINK_CACHE_FILE, LINK_CHECK_PER_HOST, LINK_CHECK_WORKERS, LinkChecker, build_dataset,
+    csv_frame, dataset_urls, export_rows, fetch_csv, fetch_dataset, link_status_text, prepare_import, read_rows,
+    send_rows_batch, split_csv_lines, upload_csv,
+)
+
+# Searches timed by the bench command, from broad to narrow
+BENCH_SEARCHES = ['a', 'ac', 'act', 'http', 'https://', '.com/']
+# Most a new process may take to import the app before it can open the window,
+# in ms. pandas and requests are most of it.
+STARTUP_BUDGET_MS = 1000
+# Run in a fresh python by the startup command, prints what the app measured about its own imports
+STARTUP_PROBE = ("import json, sys, CSVAPP; print(json.dumps({'imports': CSVAPP.IMPORT_SECONDS, "
+                 "'slowest': CSVAPP.import_timer.slowest(10), "
+                 "'eager': [name for name in CSVAPP.DEFERRED_IMPORTS if name in sys.modules]}))")
+
+
+def load(args):
+    dataset = fetch_dataset(use_cache=not args.no_cache)
+    if 'df' not in dataset:
+        sys.exit(f"Error: could not get the data from the server ({dataset['status']})")
+    if dataset['status'] == 'offline':
+        print("Warning: server not reachable, using the cached copy", file=sys.stderr)
+    return dataset
+
+
+def filters_from(args):
+    return {
+        'activity': args.activity or '',
+        'live': args.live or '',
+        'business_unit': args.business_unit or '',
+        'environment': args.environment or '',
+    }
+
+
+def write_csv(df, output):
+    if output:
+        csv_frame(df).to_csv(output, index=False)
+    else:
+        csv_frame(df).to_csv(sys.stdout, index=False, lineterminator='\n')
+
+
+def run_query(args):
+    dataset = load(args)
+    positions = dataset['query_engine'].query(args.search or '', filters_from(args))
+    if args.url:
+        positions = np.intersect1d(positions, dataset['query_engine'].url_index.rows_for(args.url))
+    if args.sort:
+        positions = dataset['query_engine'].sort_index.sorted_positions(positions, args.sort, args.descending)
+    write_csv(dataset['df'].iloc[positions], args.output)
+    print(f"{len(positions)} of {len(dataset['df'])} rows", file=sys.stderr)
+
+
+def run_export(args):
+    dataset = load(args)
+    export_rows(dataset['df'], args.file)
+    print(f"Exported {len(dataset['df'])} rows to {args.file}", file=sys.stderr)
+
+
+def run_import(args):
+    if args.replace:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            csv_data = f.read()
+        response = upload_csv(csv_data)
+        if response.status_code != 200:
+            sys.exit(f"Error {response.status_code}: {response.text}")
+        print(f"Uploaded {args.file}, server version {response.json().get('version')}", file=sys.stderr)
+        return
+
+    dataset = load(args)
+    result = prepare_import(args.file, dataset['df'][['title', 'url']], dataset['df'].columns)
+    for error in result['errors']:
+        print(error, file=sys.stderr)
+    print(f"{len(result['lines'])} new rows, {result['skipped']} already there, {len(result['errors'])} with errors",
+          file=sys.stderr)
+    if not result['lines'] or args.dry_run:
+        return
+
+    response = send_rows_batch(result['lines'], dataset['cache']['version'], result['header'])
+    if response.status_code != 200:
+        sys.exit(f"Error {response.status_code}: {response.text}")
+    print(f"Added {response.json().get('added')} rows, server version {response.json().get('version')}", file=sys.stderr)
+
+
+def run_overlaps(args):
+    dataset = load(args)
+    df = dataset['df']
+    report = dataset['query_engine'].url_index.overlaps(live_only=not args.all)
+    if args.environment:
+        report = [group for group in report if group['environment'] == args.environment]
+
+    titles = df['title'].tolist()
+    for group in report:
+        print(f"{group['environment'] or '(no environment)'}\t{len(group['positions'])} activities\t{' '.join(group['urls'])}")
+        for position in group['positions']:
+            print(f"\t{titles[position]}")
+    print(f"{len(report)} shared pages", file=sys.stderr)
+
+
+def run_check_links(args):
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8', newline='') as f:
+            lines = split_csv_lines(f.read())
+        df = read_rows(lines[0], lines[1:])
+    else:
+        df = load(args)['df']
+
+    checker = LinkChecker(workers=args.workers, per_host=args.per_host, timeout=args.timeout,
+                          cache_file=None if args.no_cache else LINK_CACHE_FILE)
+    start = time.perf_counter()
+    results = checker.check_all(dataset_urls(df), force=args.fresh)
+    seconds = time.perf_counter() - start
+
+    titles = {}
+    for title, urls in zip(df['title'].tolist(), df['url'].tolist()):
+        for url in urls:
+            titles.setdefault(url, title)
+    dead = [url for url, result in results.items() if not result['ok']]
+    for url in dead:
+        print(f"{link_status_text(results[url])}\t{url}\t{titles[url]}")
+    print(f"{len(results)} URLs checked in {seconds:.1f}s, {len(dead)} not working", file=sys.stderr)
+    if dead:
+        sys.exit(1)
+
+
+def timed(results, name, work):
+    start = time.perf_counter()
+    value = work()
+    results.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+
+def run_bench(args):
+    # Every step on its own so regressions show up where they happen. The fetch
+    # is a full download, the cache is neither read nor written.
+    results = {}
+    for _ in range(args.repeat):
+        cache, status = timed(results, 'fetch', lambda: fetch_csv(use_cache=False))
+        if cache is None or status == 'offline':
+            sys.exit(f"Error: could not get the data from the server ({status})")
+        timed(results, 'parse', lambda: read_rows(cache['header'], cache['rows']))
+        dataset = timed(results, 'build dataset', lambda: build_dataset(cache))
+
+        engine = dataset['query_engine']
+        for search in BENCH_SEARCHES:
+            timed(results, f"search '{search}'", lambda: engine.search_index.search(search))
+            engine.search_index.last_query = None  # Each search from scratch
+        live = timed(results, 'filter live+activity', lambda: engine.query('', {'live': 'True', 'activity': 'activity'}))
+        timed(results, 'sort by title (first)', lambda: engine.sort_index.order('title'))
+        timed(results, 'sort filtered by title', lambda: engine.sort_index.sorted_positions(live, 'title'))
+
+    print(f"{len(cache['rows'])} rows, {args.repeat} runs")
+    for name, seconds in results.items():
+        seconds = np.array(seconds) * 1000
+        print(f"{name:24} median {np.median(seconds):8.1f} ms   min {seconds.min():8.1f} ms   max {seconds.max():8.1f} ms")
+
+
+def run_startup(args):
+    # Every run is a new process, nothing is imported yet, the way the exe starts
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+    totals = []
+    imports = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env=env, capture_output=True, text=True)
+        totals.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            sys.exit(f"Error: the app failed to import\n{result.stderr}")
+        probe = json.loads(result.stdout.splitlines()[-1])
+        imports.append(probe['imports'])
+
+    for name, own, cumulative in probe['slowest']:
+        print(f"{name:32} {cumulative * 1000:8.1f} ms   own {own * 1000:8.1f} ms")
+    total = np.median(totals) * 1000
+    print(f"process start to imports done: median {total:.0f} ms, imports {np.median(imports) * 1000:.0f} ms, "
+          f"budget {args.budget:.0f} ms ({args.repeat} runs)")
+    if probe['eager']:
+        sys.exit(f"Error: imported at startup instead of on first use: {', '.join(probe['eager'])}")
+    if total > args.budget:
+        sys.exit(f"Error: startup over budget by {total - args.budget:.0f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query, export and import the target activity data")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the local cache")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query = commands.add_parser('query', help="print the rows matching a search and filters as CSV")
+    query.add_argument('--search', help="text to look for in title, activity, geo target and URLs")
+    query.add_argument('--activity')
+    query.add_argument('--live', choices=['True', 'False'])
+    query.add_argument('--business-unit')
+    query.add_argument('--environment')
+    query.add_argument('--url', help="only rows using this page, however the URL is written")
+    query.add_argument('--sort', choices=DISPLAY_COLUMNS + [ID_COLUMN], help="sort by this column, default file order")
+    query.add_argument('--descending', action='store_true')
+    query.add_argument('--output', help="write to this file instead of stdout")
+    query.set_defaults(run=run_query)
+
+    export = commands.add_parser('export', help="write every row to a CSV or JSON file")
+    export.add_argument('file')
+    export.set_defaults(run=run_export)
+
+    upload = commands.add_parser('import', help="check the rows in a CSV or JSON file and add the new ones")
+    upload.add_argument('file')
+    upload.add_argument('--dry-run', action='store_true', help="only check the file")
+    upload.add_argument('--replace', action='store_true', help="upload the CSV file as the server's whole data instead")
+    upload.set_defaults(run=run_import)
+
+    bench = commands.add_parser('bench', help="time the fetch, parse and query steps")
+    bench.add_argument('--repeat', type=int, default=3)
+    bench.set_defaults(run=run_bench)
+
+    overlaps = commands.add_parser('overlaps', help="list pages used by more than one live activity in the same environment")
+    overlaps.add_argument('--environment')
+    overlaps.add_argument('--all', action='store_true', help="include activities that aren't live")
+    overlaps.set_defaults(run=run_overlaps)
+
+    links = commands.add_parser('check-links', help="check that every URL still answers")
+    links.add_argument('--file', help="check the URLs in this CSV file instead of the server's data")
+    links.add_argument('--workers', type=int, default=LINK_CHECK_WORKERS)
+    links.add_argument('--per-host', type=int, default=LINK_CHECK_PER_HOST, help="requests at once to the same host")
+    links.add_argument('--timeout', type=float, default=10, help="seconds to wait for each URL")
+    links.add_argument('--fresh', action='store_true', help="check everything again, even recently checked URLs")
+    links.set_defaults(run=run_check_links)
+
+    startup = commands.add_parser('startup', help="time importing the app in a new process and check it against a budget")
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.add_argument('--budget', type=float, default=STARTUP_BUDGET_MS, help="ms, the median has to stay under it")
+    startup.set_defaults(run=run_startup)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1223 @@
+# Everything about the activity data that doesn't need a window: fetching and
+# syncing with the server, parsing, the query engine and the on-disk cache.
+# CSVAPP.py drives it for the GUI, targetCLI.py for scripts and benchmarks.
+import time
+import threading
+import itertools
+import heapq
+import pickle
+import json
+import os
+import sys
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import urlparse, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pandas as pd
+import numpy as np
+import urlFileChecker
+
+headers = {
+    'User-Agent': 'targetLookUp/1.0'
+}
+# (connect, read) timeout in seconds for server calls
+REQUEST_TIMEOUT = (5, 30)
+# Retries for GET/HEAD on connection errors and 502/503/504, waiting 0.5s, 1s, 2s
+REQUEST_RETRIES = 3
+REQUEST_BACKOFF = 0.5
+# Local copy of the last target.csv we got from the server, used for delta syncs.
+# Also holds the parsed DataFrame and search index so startup doesn't parse the CSV.
+CACHE_FILE = 'target_cache.pkl'
+CACHE_FORMAT = 2  # Bump when the cache contents change shape
+# Row edits not on the server yet, and how many go in one request
+JOURNAL_FILE = 'pending_edits.json'
+SYNC_BATCH_LIMIT = 500
+# DataFrame columns in the order the Treeview shows them
+DISPLAY_COLUMNS = ['title', 'activity', 'geo_target', 'business_unit', 'url', 'live', 'end date', 'environment']
+# Parsed types for the low-cardinality and True/False columns, see normalize_schema
+CATEGORY_COLUMNS = ['activity', 'business_unit', 'environment']
+# Every row's id, first in the file. Given out by the server, new rows have none until it answers.
+ID_COLUMN = 'id'
+BOOL_COLUMNS = ['live', 'geo_target']
+DATE_FORMAT = '%Y-%m-%d'
+NO_END_DATE = 'NAN'  # How the CSV spells a missing end date
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Columns the search box looks in
+SEARCH_COLUMNS = ['title', 'activity', 'geo_target', 'url']
+# The server sends a heartbeat every 20s on /events, so a read timeout means the connection is gone
+EVENT_READ_TIMEOUT = 60
+# Allowed values, for the comboboxes and for checking imports
+ACTIVITY_TYPES = ['activity', 'A/B']
+BUSINESS_UNITS = ['Corp', 'School', 'HigherEd', 'Sharpen', 'Professional']
+ENVIRONMENTS = ['QALV', 'PROD']
+URL_PATTERN = r'https?://[^\s/;]+[^\s;]*'
+# URL health checks: threads in total, at most this many at once per host, (connect, read)
+# timeout, and how long a result is trusted before the URL is checked again (seconds)
+LINK_CHECK_WORKERS = 32
+LINK_CHECK_PER_HOST = 4
+LINK_CHECK_TIMEOUT = (5, 10)
+LINK_CHECK_TTL = 6 * 60 * 60
+LINK_CACHE_FILE = 'link_cache.pkl'
+# What an imported row gets when the file leaves a column out
+IMPORT_DEFAULTS = {'geo_target': 'False', 'live': 'False', 'end date': NO_END_DATE, 'business_unit': '', 'environment': ''}
+
+
+class QueryEngine:
+    # Rows matching the search text and every combobox filter at once. The mask
+    # for each (column, value) filter is cached, so changing one combobox only
+    # computes one new mask and the rest is NumPy ands.
+    # The GUI queries on a worker thread while edits come in on the Tk thread,
+    # the lock keeps the two apart. version counts the edits, a result made
+    # at an older version is missing the newer ones. rows counts the rows the
+    # indexes know about, df can already have a new row update_row hasn't seen.
+    def __init__(self, df, search_index=None):
+        self.df = df
+        self.search_index = search_index if search_index is not None else SearchIndex(df)
+        self.url_index = UrlIndex(df)
+        self.sort_index = SortIndex(df)
+        self.masks = {}
+        self.lock = threading.Lock()
+        self.version = 0
+        self.rows = len(df)
+
+    def query(self, search_term='', filters=None):
+        return self.versioned_query(search_term, filters)[1]
+
+    def versioned_query(self, search_term='', filters=None):
+        # (version, positions)
+        with self.lock:
+            mask = np.ones(self.rows, dtype=bool)
+            for column, value in (filters or {}).items():
+                if value:
+                    mask &= self.column_mask(column, value)
+
+            if search_term:
+                text_mask = np.zeros(self.rows, dtype=bool)
+                text_mask[self.search_index.search(search_term)] = True
+                mask &= text_mask
+            return self.version, np.flatnonzero(mask)
+
+    def column_mask(self, column, value):
+        key = (column, value)
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = filter_matches(self.df, column, value)[:self.rows]
+            self.masks[key] = mask
+        return mask
+
+    def update_row(self, position, row):
+        # Patch the cached masks for just this row
+        row_df = pd.DataFrame([row])
+        with self.lock:
+            self.version += 1
+            self.rows = max(self.rows, position + 1)
+            self.search_index.update_row(position, row)
+            self.url_index.update_row(position, row)
+            self.sort_index.update_row(position, row)
+            for (column, value), mask in list(self.masks.items()):
+                matches = filter_matches(row_df, column, value)
+                if position == len(mask):
+                    self.masks[(column, value)] = np.append(mask, matches)
+                else:
+                    mask[position] = matches[0]
+
+
+def filter_matches(df, column, value):
+    if column not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    if column in BOOL_COLUMNS:
+        return df[column].to_numpy(dtype=bool) == (value.lower() == 'true')
+    # Categoricals compare on their codes
+    return (df[column] == value).to_numpy(dtype=bool, na_value=False, copy=True)
+
+
+class SearchIndex:
+    # Plain substring search over the SEARCH_COLUMNS, built once per load.
+    # Each row gets one lowercased haystack, and a trigram index over the title,
+    # activity, geo target and every ;-separated URL narrows down which
+    # haystacks a query has to be checked against.
+    def __init__(self, df):
+        fields = [pd.Series(display_column(df, column), dtype=object).fillna('').astype(str).str.lower()
+                  for column in SEARCH_COLUMNS]
+        self.haystacks = ['\n'.join(row) for row in zip(*fields)]
+
+        postings = defaultdict(list)
+        for position, haystack in enumerate(self.haystacks):
+            for trigram in row_trigrams(haystack):
+                postings[trigram].append(position)
+        self.postings = {trigram: np.array(rows, dtype=np.int32) for trigram, rows in postings.items()}
+
+        # Rows edited since the index was built, always checked because their postings are stale
+        self.dirty = set()
+        self.last_query = None
+        self.last_result = None
+
+    def snapshot(self):
+        # A copy that can be pickled on another thread while this one keeps changing
+        copy = SearchIndex.__new__(SearchIndex)
+        copy.haystacks = list(self.haystacks)
+        copy.postings = dict(self.postings)
+        copy.dirty = set(self.dirty)
+        copy.last_query = None
+        copy.last_result = None
+        return copy
+
+    def update_row(self, position, row):
+        haystack = '\n'.join(display_value(column, row.get(column, '')).lower() for column in SEARCH_COLUMNS)
+        if position == len(self.haystacks):
+            self.haystacks.append(haystack)
+        else:
+            self.haystacks[position] = haystack
+        self.dirty.add(position)
+        self.last_query = None
+
+    def search(self, query):
+        query = query.lower()
+        if not query:
+            result = np.arange(len(self.haystacks))
+        else:
+            if self.last_query and self.last_query in query:
+                # Typing more only narrows the previous matches
+                candidates = self.last_result.tolist()
+            elif len(query) >= 3 and ';' not in query and '\n' not in query:
+                candidates = self.lookup(query)
+            else:
+                candidates = range(len(self.haystacks))
+
+            haystacks = self.haystacks
+            result = np.array([position for position in candidates if query in haystacks[position]], dtype=np.intp)
+
+        self.last_query = query
+        self.last_result = result
+        return result
+
+    def lookup(self, query):
+        # Rows that contain every trigram of the query, smallest posting list first
+        rows = []
+        for trigram in {query[i:i + 3] for i in range(len(query) - 2)}:
+            posting = self.postings.get(trigram)
+            if posting is None:
+                rows = None
+                break
+            rows.append(posting)
+
+        if rows:
+            rows.sort(key=len)
+            candidates = rows[0]
+            for posting in rows[1:]:
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        else:
+            candidates = np.array([], dtype=np.int32)
+
+        if self.dirty:
+            candidates = np.union1d(candidates, list(self.dirty))
+        return candidates.tolist()
+
+
+def row_trigrams(haystack):
+    trigrams = set()
+    for field in haystack.replace(';', '\n').split('\n'):
+        for i in range(len(field) - 2):
+            trigrams.add(field[i:i + 3])
+    return trigrams
+
+
+class UrlIndex:
+    # Which rows every page is used in, keyed by normalize_url so the same page
+    # written two ways is one entry. Finding the activities on a page is one
+    # lookup, and overlaps() goes through each page's rows once instead of
+    # comparing every pair of rows.
+    def __init__(self, df):
+        self.df = df
+        self.row_keys = []
+        self.postings = defaultdict(set)
+        urls = df['url'].tolist() if 'url' in df.columns else [()] * len(df)
+        for position, row_urls in enumerate(urls):
+            keys = {normalize_url(url) for url in row_urls}
+            self.row_keys.append(keys)
+            for key in keys:
+                self.postings[key].add(position)
+
+    def update_row(self, position, row):
+        keys = {normalize_url(url) for url in split_urls(row.get('url', ()))}
+        if position == len(self.row_keys):
+            self.row_keys.append(set())
+        for key in self.row_keys[position] - keys:
+            self.postings[key].discard(position)
+            if not self.postings[key]:
+                del self.postings[key]
+        for key in keys:
+            self.postings[key].add(position)
+        self.row_keys[position] = keys
+
+    def rows_for(self, url, live_only=False):
+        # Positions of the rows using url, sorted
+        positions = np.array(sorted(self.postings.get(normalize_url(url), ())), dtype=np.intp)
+        if live_only and len(positions):
+            positions = positions[live_column(self.df)[positions]]
+        return positions
+
+    def overlaps(self, live_only=True):
+        # Pages used by more than one activity in the same environment, as
+        # [{'environment', 'urls', 'positions'}], most rows first. Pages shared
+        # by exactly the same rows are reported together.
+        live = live_column(self.df)
+        if 'environment' in self.df.columns:
+            environments = display_column(self.df, 'environment')
+        else:
+            environments = [''] * len(self.df)
+
+        groups = {}
+        for key, positions in self.postings.items():
+            by_environment = defaultdict(list)
+            for position in positions:
+                if position < len(live) and (live[position] or not live_only):
+                    by_environment[environments[position]].append(position)
+            for environment, rows in by_environment.items():
+                if len(rows) > 1:
+                    rows.sort()
+                    group = groups.setdefault((environment, tuple(rows)), {
+                        'environment': environment, 'urls': [], 'positions': rows})
+                    group['urls'].append(key)
+
+        report = sorted(groups.values(), key=lambda group: (-len(group['positions']), group['environment']))
+        for group in report:
+            group['urls'].sort()
+        return report
+
+
+class SortIndex:
+    # One argsort permutation per column, made the first time the table is
+    # sorted by that column and patched row by row on edits after that.
+    # Sorting a filtered view is then picking the shown rows out of the
+    # permutation in order, order[mask[order]], without comparing anything.
+    def __init__(self, df):
+        self.df = df
+        self.keys = {}
+        self.orders = {}
+
+    def order(self, column):
+        if column not in self.orders:
+            self.keys[column] = sort_keys(self.df, column)
+            self.orders[column] = np.argsort(self.keys[column], kind='stable')
+        return self.orders[column]
+
+    def sorted_positions(self, positions, column, descending=False):
+        order = self.order(column)
+        shown = np.zeros(len(order), dtype=bool)
+        shown[positions] = True
+        result = order[shown[order]]
+        return result[::-1].copy() if descending else result
+
+    def update_row(self, position, row):
+        if not self.orders:
+            return
+        row_df = pd.DataFrame([row])
+        for column in list(self.orders):
+            key = sort_keys(row_df, column)
+            keys = self.keys[column]
+            order = self.orders[column]
+            if keys.dtype.kind == 'U' and key.dtype.itemsize > keys.dtype.itemsize:
+                keys = keys.astype(key.dtype)  # A longer string than any so far would be cut off
+            if position < len(keys):
+                order = order[order != position]
+                keys[position] = key[0]
+            else:
+                keys = np.append(keys, key)
+            at = np.searchsorted(keys[order], key[0], side='right')
+            self.keys[column] = keys
+            self.orders[column] = np.insert(order, at, position)
+
+
+def sort_keys(df, column):
+    # Something NumPy can sort natively for every row: dates as numbers with no
+    # end date last, ids by number, text case-insensitively
+    if column not in df.columns:
+        return np.zeros(len(df), dtype=np.int8)
+    if column == 'end date':
+        keys = pd.to_datetime(df[column]).to_numpy(dtype='datetime64[ns]').view(np.int64).copy()
+        keys[keys == np.iinfo(np.int64).min] = np.iinfo(np.int64).max  # NaT
+        return keys
+    if column == ID_COLUMN:
+        return pd.to_numeric(df[column], errors='coerce').fillna(np.inf).to_numpy(dtype=float)
+    if column in BOOL_COLUMNS:
+        return df[column].to_numpy(dtype=bool).astype(np.int8)
+    return np.array([display_value(column, value).lower() for value in df[column].tolist()], dtype=str)
+
+
+@lru_cache(maxsize=None)
+def normalize_url(url):
+    # The scheme, case of the host, www., default ports, repeated or trailing
+    # slashes, the fragment and the order of query parameters don't make it a
+    # different page
+    url = url.strip()
+    parts = urlsplit(url if '//' in url else '//' + url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port not in (80, 443):
+        host += f':{port}'
+    path = re.sub('/+', '/', parts.path).rstrip('/')
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param))
+    return host + path + ('?' + query if query else '')
+
+
+def build_dataset(cache, df=None, search_index=None):
+    # Everything the table needs for one copy of the data, safe to run on a worker thread.
+    # df and search_index come from the on-disk cache when they were saved with it.
+    if df is None:
+        df = read_rows(cache['header'], cache['rows'])
+        search_index = None
+    render_data = compute_render_data(df)
+    return {
+        'cache': cache,
+        'row_lines': list(cache['rows']),
+        'df': df,
+        'render_data': render_data,
+        'query_engine': QueryEngine(df, search_index),
+        'expiry_index': ExpiryIndex(render_data[2], live_column(df)),
+    }
+
+
+def build_saved_dataset(cache, status):
+    # build_dataset plus writing it to the on-disk cache, for data fresh from the server
+    dataset = build_dataset(cache)
+    dataset['status'] = status
+    if status != 'offline':
+        save_cache(cache, dataset['df'], dataset['query_engine'].search_index)
+    return dataset
+
+
+def load_cached_dataset():
+    stored = load_cache_file()
+    if stored is None:
+        return None
+    return build_dataset(stored['cache'], stored['df'], stored['search_index'])
+
+
+def compute_render_data(df):
+    # Treeview values, tag and parsed end date for every row, done column-wise
+    columns = [display_column(df, column) for column in DISPLAY_COLUMNS]
+    values = list(zip(*columns))
+
+    if 'end date' in df.columns:
+        end_dates = df['end date']
+    else:
+        end_dates = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    live = live_column(df)
+
+    # Live activities whose end date has passed
+    expired = live & (end_dates < pd.Timestamp.now().normalize()).to_numpy()
+    tags = np.where(expired, 'expired', np.where(live, 'live', 'not_live')).tolist()
+    return values, tags, end_dates.to_numpy(copy=True)
+
+
+def live_column(df):
+    if 'live' not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    return df['live'].to_numpy(dtype=bool)
+
+
+class ExpiryIndex:
+    # Live rows that haven't expired yet, in a heap by the time they do, so the
+    # app can wake up exactly when the next one expires instead of rescanning
+    # every row. A row expires when the day after its end date starts, the
+    # same rule compute_render_data tags 'expired' by. Edits push a new entry
+    # and the old one is skipped when it comes up.
+    def __init__(self, end_dates, live):
+        self.expires_at = {}  # position -> expiry time in ns, only for rows still waiting
+        self.heap = []
+        expires = np.asarray(end_dates, dtype='datetime64[ns]') + np.timedelta64(1, 'D')
+        pending = np.flatnonzero(np.asarray(live, dtype=bool) & (expires > np.datetime64(pd.Timestamp.now())))
+        times = expires[pending].astype(np.int64).tolist()
+        for position, expiry in zip(pending.tolist(), times):
+            self.expires_at[position] = expiry
+            self.heap.append((expiry, position))
+        heapq.heapify(self.heap)
+
+    def update_row(self, position, end_date, live):
+        self.expires_at.pop(position, None)
+        if not live or pd.isna(end_date):
+            return
+        expiry = (pd.Timestamp(end_date) + pd.Timedelta(days=1)).value
+        if expiry > pd.Timestamp.now().value:
+            self.expires_at[position] = expiry
+            heapq.heappush(self.heap, (expiry, position))
+
+    def next_expiry(self):
+        # pd.Timestamp of the next row to expire, None if nothing is waiting
+        heap = self.heap
+        while heap and self.expires_at.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return pd.Timestamp(heap[0][0]) if heap else None
+
+    def pop_expired(self, now=None):
+        # Positions of the rows that have expired by now
+        now = (now or pd.Timestamp.now()).value
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            expiry, position = heapq.heappop(heap)
+            if self.expires_at.get(position) == expiry:
+                del self.expires_at[position]
+                expired.append(position)
+        return expired
+
+
+class HttpClient:
+    # Every server call goes through one pooled requests.Session, so connections
+    # are kept alive between calls. Each call gets REQUEST_TIMEOUT unless it
+    # passes its own, GET/HEAD are retried with backoff (the row edits are not,
+    # a retried edit that already went through would come back as a conflict),
+    # and the time spent per endpoint is counted for the diagnostics window.
+    def __init__(self):
+        retry = Retry(total=REQUEST_RETRIES, backoff_factor=REQUEST_BACKOFF,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD']))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': headers['User-Agent'], 'Accept-Encoding': 'gzip, deflate'})
+
+        self.lock = threading.Lock()
+        self.stats = {}  # 'GET /download' -> {'calls', 'errors', 'total', 'max'}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        endpoint = f"{method} {urlparse(url).path or '/'}"
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            self.record(endpoint, time.perf_counter() - start, failed)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def record(self, endpoint, seconds, failed):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def report(self):
+        with self.lock:
+            lines = [f"{endpoint}: {stats['calls']} calls, {stats['errors']} errors, "
+                     f"avg {stats['total'] / stats['calls'] * 1000:.0f} ms, max {stats['max'] * 1000:.0f} ms"
+                     for endpoint, stats in sorted(self.stats.items())]
+        return "\n".join(lines) or "No server calls yet"
+
+
+http_client = HttpClient()
+
+
+def server_route(route):
+    # urlFileChecker only has the download/upload urls, the other routes sit next to them
+    return urlFileChecker.url.rsplit('/', 1)[0] + '/' + route
+
+
+# Talking to the server. These block, the GUI runs them on worker threads.
+
+def split_csv_lines(text):
+    # Rows the way the server's splitCsv makes them: only \n or \r\n ends a
+    # line. str.splitlines also splits on \r, \x85, \u2028 and the like, and
+    # a field holding one of those would turn one row into two.
+    return [line for line in re.split(r'\r?\n', text) if line]
+
+
+def iter_csv_lines(response):
+    # The same for a streamed response, as the chunks arrive
+    pending = ''
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE, decode_unicode=True):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith('\r') else line
+    if pending:
+        yield pending[:-1] if pending.endswith('\r') else pending
+
+
+def fetch_csv(use_cache=True):
+    # Returns (cache, status), status is 'changed', 'unchanged' or 'offline'.
+    # With use_cache the local copy is only brought up to date, see fetch_csv_from_server.
+    cache = load_cache() if use_cache else None
+    try:
+        return fetch_csv_from_server(cache)
+    except requests.RequestException as e:
+        print(f"Error fetching data: {e}")
+        # Stale data is better than an empty table
+        return cache, 'offline'
+
+
+def fetch_csv_from_server(cache):
+    request_headers = dict(urlFileChecker.headers)
+
+    if cache:
+        if cache['version']:
+            # Only ask for the rows that changed since our cached copy
+            response = http_client.get(server_route('delta'), headers=request_headers, params={'since': cache['version']})
+            if response.status_code == 304:
+                return cache, 'unchanged'
+            if response.status_code == 200:
+                delta = response.json()
+                if delta.get('header') == cache['header']:
+                    cache['rows'] = apply_delta(cache['rows'], delta.get('removed', []), delta.get('added', []))
+                    cache['version'] = delta.get('version')
+                    cache['last_modified'] = response.headers.get('Last-Modified')
+                    return cache, 'changed'
+            # Anything else (old server, history gone, header changed) means a full download
+
+        # Let the server tell us our copy is still current
+        if cache['version']:
+            request_headers['If-None-Match'] = '"%s"' % cache['version']
+        if cache['last_modified']:
+            request_headers['If-Modified-Since'] = cache['last_modified']
+
+    # Streamed and decompressed as it arrives, straight into the row list
+    response = http_client.get(urlFileChecker.url, headers=request_headers, stream=True)
+
+    if response.status_code == 304 and cache:
+        response.close()
+        return cache, 'unchanged'
+
+    # Check for successful response before processing the CSV data
+    if response.status_code == 200:
+        response.encoding = response.encoding or 'utf-8'
+        lines = iter_csv_lines(response)
+        header = next(lines, '')
+        cache = {
+            'version': response.headers.get('X-Data-Version'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'header': header,
+            'rows': [line for line in lines if line],
+        }
+        return cache, 'changed'
+
+    # Handle potential error (e.g., invalid token, server error, etc.)
+    print(f"Error {response.status_code}: {response.text}")
+    # Stale data is better than an empty table
+    return cache, 'offline'
+
+
+def fetch_dataset(current=None, use_cache=True):
+    # A dataset (see build_dataset) with the server's current data, or just
+    # {'status'} when current, the cache dict already in use, is up to date
+    cache, status = fetch_csv(use_cache)
+    if cache is None:
+        return {'status': status}
+
+    if status != 'changed' and current is not None and current['version'] == cache['version']:
+        return {'status': status}  # What we show is already current
+
+    if not use_cache:
+        dataset = build_dataset(cache)
+        dataset['status'] = status
+        return dataset
+    return build_saved_dataset(cache, status)
+
+
+def row_to_line(df, position):
+    # Same CSV formatting the server stores, so the server can tell whether the row changed
+    return csv_frame(df.iloc[[position]]).to_csv(index=False, header=False, lineterminator='\n').rstrip('\n')
+
+
+def line_id(line):
+    # The id column of a CSV line, '' for a row the server hasn't seen yet
+    return line.split(',', 1)[0]
+
+
+def upload_csv(csv_data):
+    # Replaces the whole file on the server
+    files = {'file': ('target.csv', csv_data)}
+    return http_client.post(urlFileChecker.urlUpload, headers=urlFileChecker.headers, files=files)
+
+
+def open_change_stream():
+    return http_client.get(server_route('events'), headers=urlFileChecker.headers, stream=True,
+                           timeout=(REQUEST_TIMEOUT[0], EVENT_READ_TIMEOUT))
+
+
+def read_changes(response):
+    # Server-sent events: 'event:' and 'data:' lines, a blank line ends each
+    # one, lines starting with ':' are heartbeats. Yields (event, data) for the
+    # hello the server sends on connecting, with its current version, and for
+    # every change event.
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if event in ('hello', 'change') and data:
+                yield event, json.loads('\n'.join(data))
+            event, data = None, []
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            data.append(line[5:].strip())
+
+
+def send_edits(ops, version, header):
+    # A batch of queued edits (see EditJournal) in one request. The answer has a
+    # result per edit: ok with the row as stored, or conflict with the current row.
+    payload = {'version': version, 'header': header, 'ops': ops}
+    return http_client.post(server_route('rows/sync'), headers=urlFileChecker.headers, json=payload)
+
+
+class EditJournal:
+    # Row edits that haven't reached the server yet, written to disk on every
+    # change so they survive a crash or closing the app while offline.
+    # Entries are {'op': 'add' or 'update', 'id', 'old', 'row'}, a new row's id
+    # is the made-up one until the server gives it a real one. Edits to the
+    # same row are folded together until they're sent, so a row edited five
+    # times goes out once. The first `sending` entries are on their way to the
+    # server and aren't touched until the answer is in.
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.entries = []
+        self.sending = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = []
+        except Exception as e:
+            print(f"Error reading pending edits: {e}")
+            self.entries = []
+        self.fold_into_adds()  # The app may have closed with a batch on its way
+
+    def save(self):
+        temp_file = self.path + '.tmp'
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            print(f"Error saving pending edits: {e}")
+
+    def waiting(self):
+        # Entries not sent yet
+        return self.entries[self.sending:]
+
+    def record(self, row_id, old, row):
+        for entry in self.waiting():
+            if entry['id'] == row_id:
+                entry['row'] = row  # Still goes out as one edit from the first old row
+                self.save()
+                return
+        # A row without a server id is new, unless its add is already on the way
+        sent_add = any(entry['id'] == row_id and entry['op'] == 'add' for entry in self.entries[:self.sending])
+        op = 'update' if (old and line_id(old)) or sent_add else 'add'
+        self.entries.append({'op': op, 'id': row_id, 'old': old if op == 'update' else None, 'row': row})
+        self.save()
+
+    def rebase(self, row_id, current, row):
+        # Send our edit again on top of the server's current row, after a conflict
+        for entry in self.waiting():
+            if entry['id'] == row_id:
+                entry['old'] = current  # A newer edit of ours is already waiting, it goes instead
+                self.save()
+                return
+        self.entries.append({'op': 'update', 'id': row_id, 'old': current, 'row': row})
+        self.save()
+
+    def row_ids(self):
+        return {entry['id'] for entry in self.entries}
+
+    def take(self, limit=SYNC_BATCH_LIMIT):
+        self.sending = min(len(self.entries), limit)
+        return [dict(entry) for entry in self.entries[:self.sending]]
+
+    def sent(self):
+        # The batch from take() is done with, whether it went through or not
+        del self.entries[:self.sending]
+        self.sending = 0
+        self.save()
+
+    def failed(self):
+        # The batch never got there, it goes out again with the next one
+        self.sending = 0
+        self.fold_into_adds()
+        self.save()
+
+    def fold_into_adds(self):
+        # Edits queued behind an add that was on its way refer to the made-up
+        # id. If the add goes out again they have to go with it, the server
+        # only knows the row by its id once the add is through.
+        adds = {entry['id']: entry for entry in self.entries[self.sending:] if entry['op'] == 'add'}
+        kept = self.entries[:self.sending]
+        for entry in self.entries[self.sending:]:
+            if entry['op'] == 'update' and entry['id'] in adds:
+                adds[entry['id']]['row'] = entry['row']
+            else:
+                kept.append(entry)
+        self.entries = kept
+
+    def rename(self, old_id, new_line):
+        # A new row got its id, edits queued for it behind the add now refer to the row as stored
+        new_id = line_id(new_line)
+        for entry in self.entries[self.sending:]:
+            if entry['id'] == old_id:
+                entry['id'] = new_id
+                entry['old'] = new_line
+                entry['row'] = new_id + entry['row'][len(line_id(entry['row'])):]
+        self.save()
+
+
+def load_cache_file():
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            stored = pickle.load(f)
+    except Exception:
+        return None
+
+    if not isinstance(stored, dict) or stored.get('format') != CACHE_FORMAT:
+        return None
+    return stored
+
+
+def load_cache():
+    stored = load_cache_file()
+    return stored['cache'] if stored else None
+
+
+cache_lock = threading.Lock()  # Saves come from several threads and share the temp file
+
+
+def save_cache(cache, df=None, search_index=None):
+    # Leave out df when it may not match the rows, it gets parsed again on the next start
+    stored = {'format': CACHE_FORMAT, 'cache': cache, 'df': df, 'search_index': search_index}
+    temp_file = CACHE_FILE + '.tmp'
+    try:
+        with cache_lock:
+            with open(temp_file, 'wb') as f:
+                pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, CACHE_FILE)  # Never leave a half written cache behind
+    except Exception as e:
+        print(f"Error saving cache: {e}")
+
+
+class RowReader:
+    # File-like view of a header and row lines for read_csv, so the rows never
+    # have to be joined into one big string just to be parsed
+    def __init__(self, header, rows):
+        self.lines = itertools.chain([header], rows)
+        self.buffer = ''
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines) + '\n'
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            parts.append(line)
+            parts.append('\n')
+            length += len(line) + 1
+            if size is not None and 0 <= size <= length:
+                break
+
+        data = ''.join(parts)
+        if size is None or size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+# The activity table once loaded:
+#   activity, business_unit, environment   category
+#   live, geo_target                       bool
+#   end date                               datetime64, NaT when there is none
+#   url                                    tuple of interned URL strings
+# csv_frame turns it back into the text the server stores, display_column and
+# display_value into what the Treeview shows.
+
+def read_rows(header, rows):
+    columns = header.split(',')
+    dtypes = {column: 'category' for column in CATEGORY_COLUMNS if column in columns}
+    if ID_COLUMN in columns:
+        dtypes[ID_COLUMN] = str
+    df = pd.read_csv(RowReader(header, rows), sep=',', dtype=dtypes)
+    return normalize_schema(df)
+
+
+def normalize_schema(df):
+    for column in BOOL_COLUMNS:
+        if column in df.columns:
+            df[column] = to_bool(df[column])
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    if 'end date' in df.columns:
+        # NAN, N/A and anything else that isn't a date become NaT
+        df['end date'] = pd.to_datetime(df['end date'], format=DATE_FORMAT, errors='coerce')
+    if 'url' in df.columns:
+        df['url'] = pd.Series([split_urls(urls) for urls in df['url'].tolist()], index=df.index, dtype=object)
+    return df
+
+
+def to_bool(values):
+    # True/False columns come back as bools, or as strings when a row is odd
+    if values.dtype == bool:
+        return values
+    return values.astype(str).str.strip().str.lower().eq('true')
+
+
+def split_urls(urls):
+    # The same URL shows up in lots of rows, interning keeps one copy of it
+    if isinstance(urls, tuple):
+        return urls
+    if not isinstance(urls, str):
+        return ()
+    return tuple(sys.intern(url.strip()) for url in urls.split(';') if url.strip())
+
+
+def normalize_value(column, value):
+    if column in BOOL_COLUMNS:
+        return value if isinstance(value, bool) else str(value).strip().lower() == 'true'
+    if column == 'end date':
+        return pd.to_datetime(value, format=DATE_FORMAT, errors='coerce')
+    if column == 'url':
+        return split_urls(value)
+    return value
+
+
+def display_value(column, value):
+    if column == 'url':
+        return ';'.join(value) if isinstance(value, tuple) else str(value)
+    if column == 'end date':
+        return NO_END_DATE if pd.isna(value) else pd.Timestamp(value).strftime(DATE_FORMAT)
+    if not isinstance(value, bool) and pd.isna(value):
+        return ''
+    return str(value)
+
+
+def display_column(df, column):
+    if column not in df.columns:
+        return [''] * len(df)
+    if column == 'url':
+        return [';'.join(urls) for urls in df['url'].tolist()]
+    if column == 'end date':
+        return df['end date'].dt.strftime(DATE_FORMAT).fillna(NO_END_DATE).tolist()
+    return df[column].tolist()
+
+
+def csv_frame(df):
+    # Copy of df with the URLs and end dates back in their CSV form
+    out = df.copy()
+    if 'url' in out.columns:
+        out['url'] = display_column(df, 'url')
+    if 'end date' in out.columns:
+        out['end date'] = display_column(df, 'end date')
+    return out
+
+
+def set_df_row(df, position, row):
+    # Write one row by column name, converting the values to the column types.
+    # position == len(df) appends.
+    appending = position == len(df)
+    values = {}
+    for column in df.columns:
+        if column not in row and not appending:
+            continue  # Columns the edit doesn't know about stay as they are
+        value = normalize_value(column, row.get(column, np.nan))
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and not pd.isna(value) and value not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories([value])
+        values[column] = value
+
+    if appending:
+        dtypes = df.dtypes.to_dict()
+        df.loc[position] = [values[column] for column in df.columns]
+        # Growing the frame through loc can turn categoricals, bools and dates into plain objects
+        for column, dtype in dtypes.items():
+            if df[column].dtype != dtype and dtype != object:
+                df[column] = df[column].astype(dtype)
+    else:
+        label = df.index[position]
+        for column, value in values.items():
+            df.at[label, column] = value
+
+
+def apply_delta(rows, removed, added):
+    # Rows are matched by content, duplicates are removed one at a time
+    pending = Counter(removed)
+    kept = []
+    for row in rows:
+        if pending[row] > 0:
+            pending[row] -= 1
+        else:
+            kept.append(row)
+    return kept + list(added)
+
+
+# Bulk import and export. Imports are checked a column at a time, matched
+# against the rows we already have through a hash index, and sent to the
+# server as one batch.
+
+def read_import_file(path):
+    # Every value as a string, .json is a list of row objects, anything else CSV
+    if path.lower().endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        df = pd.DataFrame.from_records(records)
+        return df.astype(object).where(df.notna(), '').astype(str)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def export_rows(df, path):
+    # CSV the way the server stores it, or a list of row objects for .json
+    out = csv_frame(df)
+    if path.lower().endswith('.json'):
+        out.to_json(path, orient='records', indent=1, date_format='iso')
+    else:
+        out.to_csv(path, index=False)
+
+
+def validate_rows(df, columns):
+    # Returns (rows, errors). rows has the good rows in columns order, still as
+    # strings, errors is a list of 'row N: ...' messages for the rest.
+    df = df.copy()
+    for column in columns:
+        if column not in df.columns:
+            df[column] = IMPORT_DEFAULTS.get(column, '')
+    df = df[columns].apply(lambda values: values.astype(str).str.strip())
+    for column, default in IMPORT_DEFAULTS.items():
+        if column in df.columns and default:
+            df[column] = df[column].mask(df[column] == '', default)
+    if ID_COLUMN in df.columns:
+        df[ID_COLUMN] = ''  # New rows, the server gives out the ids
+
+    problems = pd.Series('', index=df.index, dtype=object)
+
+    def flag(mask, message):
+        problems[mask] = problems[mask] + message + '; '
+
+    if 'title' in df.columns:
+        flag(df['title'] == '', 'missing title')
+    if 'activity' in df.columns:
+        flag(~df['activity'].isin(ACTIVITY_TYPES), "activity type '" + df['activity'] + "'")
+    if 'business_unit' in df.columns:
+        flag(df['business_unit'].ne('') & ~df['business_unit'].isin(BUSINESS_UNITS), "business unit '" + df['business_unit'] + "'")
+    if 'environment' in df.columns:
+        flag(df['environment'].ne('') & ~df['environment'].isin(ENVIRONMENTS), "environment '" + df['environment'] + "'")
+    for column in BOOL_COLUMNS:
+        if column in df.columns:
+            flag(~df[column].str.lower().isin(['true', 'false']), column + " '" + df[column] + "' is not True/False")
+    if 'end date' in df.columns:
+        no_date = df['end date'].str.upper().isin([NO_END_DATE, ''])
+        dates = pd.to_datetime(df['end date'], format=DATE_FORMAT, errors='coerce')
+        flag(~no_date & dates.isna(), "end date '" + df['end date'] + "' is not YYYY-MM-DD")
+    if 'url' in df.columns:
+        urls = df['url'].str.split(';').explode().str.strip()
+        urls = urls[urls != '']
+        flag(~df.index.isin(urls.index), 'no URL')
+        bad = urls[~urls.str.fullmatch(URL_PATTERN)]
+        flag(df.index.isin(bad.index), 'bad URL')
+
+    bad_rows = problems != ''
+    errors = [f"row {position + 1}: {message.rstrip('; ')}"
+              for position, message in zip(np.flatnonzero(bad_rows), problems[bad_rows])]
+    return df[~bad_rows.to_numpy()], errors
+
+
+def find_duplicates(rows, existing):
+    # Rows whose title and URLs are already there (or earlier in the file) are
+    # skipped, a known title with different URLs is an error. Both are found
+    # with set lookups, so this is linear in the size of both.
+    # Returns (mask of rows to keep, number skipped, errors).
+    def row_keys(titles, urls):
+        return [(str(title).strip().casefold(), frozenset(split_urls(url))) for title, url in zip(titles, urls)]
+
+    known = set(row_keys(existing['title'], existing['url'])) if len(existing) else set()
+    known_titles = {title for title, _ in known}
+
+    keep = np.ones(len(rows), dtype=bool)
+    skipped = 0
+    errors = []
+    for i, key in enumerate(row_keys(rows['title'], rows['url'])):
+        if key in known:
+            keep[i] = False
+            skipped += 1
+        elif key[0] in known_titles:
+            keep[i] = False
+            errors.append(f"'{rows['title'].iloc[i]}': title already used with different URLs")
+        else:
+            known.add(key)
+            known_titles.add(key[0])
+    return keep, skipped, errors
+
+
+def prepare_import(path, existing, columns=None):
+    # Everything up to the upload, safe on a worker thread. existing needs the
+    # title and url columns of the rows we have, columns is the server's column
+    # order (default: existing's).
+    columns = list(columns if columns is not None else existing.columns) or DISPLAY_COLUMNS
+    rows, errors = validate_rows(read_import_file(path), columns)
+    keep, skipped, duplicate_errors = find_duplicates(rows, existing)
+    rows = rows[keep]
+
+    # Through the same types and formatting as every other row, so the lines
+    # match what row_to_line makes
+    parsed = normalize_schema(rows.reset_index(drop=True))
+    lines = split_csv_lines(csv_frame(parsed).to_csv(index=False, header=False, lineterminator='\n')) if len(parsed) else []
+    return {'header': ','.join(columns), 'lines': lines, 'skipped': skipped, 'errors': errors + duplicate_errors}
+
+
+def send_rows_batch(lines, version, header):
+    # Adds all of lines in one server write
+    payload = {'version': version, 'header': header, 'rows': lines}
+    return http_client.post(server_route('rows/batch'), headers=urlFileChecker.headers, json=payload)
+
+
+class LinkChecker:
+    # Checks whether the activity URLs still answer. Many run at once on a
+    # thread pool, but never more than per_host against the same host, and the
+    # work is interleaved across hosts so one big site doesn't tie up every
+    # thread. HEAD first, GET for servers that refuse HEAD. Results are kept
+    # for ttl seconds, also on disk, so the next scan only checks what's new
+    # or stale.
+    def __init__(self, workers=LINK_CHECK_WORKERS, per_host=LINK_CHECK_PER_HOST, timeout=LINK_CHECK_TIMEOUT,
+                 ttl=LINK_CHECK_TTL, cache_file=LINK_CACHE_FILE):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_file = cache_file
+
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=per_host)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': headers['User-Agent']})
+
+        self.lock = threading.Lock()
+        self.host_limits = {}
+        self.results = {}  # url -> {'ok', 'status', 'error', 'checked'}
+        self.load()
+
+    def load(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                results = pickle.load(f)
+        except Exception:
+            return
+        now = time.time()
+        self.results = {url: result for url, result in results.items() if now - result['checked'] < self.ttl}
+
+    def save(self):
+        if not self.cache_file:
+            return
+        temp_file = self.cache_file + '.tmp'
+        try:
+            with self.lock:
+                results = dict(self.results)
+            with open(temp_file, 'wb') as f:
+                pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.cache_file)
+        except Exception as e:
+            print(f"Error saving link results: {e}")
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            limit = self.host_limits.get(host)
+            if limit is None:
+                limit = self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+        return limit
+
+    def check(self, url):
+        result = {'ok': False, 'status': None, 'error': '', 'checked': time.time()}
+        with self.host_limit(url):
+            try:
+                response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+                if response.status_code in (403, 405, 501):
+                    # Some servers don't do HEAD or refuse it, ask for the page but don't download it
+                    response = self.session.get(url, timeout=self.timeout, allow_redirects=True, stream=True)
+                    response.close()
+                result['status'] = response.status_code
+                result['ok'] = response.status_code < 400
+            except requests.RequestException as e:
+                result['error'] = type(e).__name__
+        with self.lock:
+            self.results[url] = result
+        return result
+
+    def check_all(self, urls, on_result=None, force=False):
+        # Returns {url: result} for every url in urls. on_result(url, result) is
+        # called from the worker threads as each new check finishes.
+        now = time.time()
+        unique = list(dict.fromkeys(urls))
+        with self.lock:
+            todo = [url for url in unique if force or url not in self.results
+                    or now - self.results[url]['checked'] >= self.ttl]
+
+        by_host = defaultdict(list)
+        for url in todo:
+            by_host[urlparse(url).netloc.lower()].append(url)
+        # One URL from each host in turn
+        order = [url for batch in itertools.zip_longest(*by_host.values()) for url in batch if url is not None]
+
+        if order:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(self.check, url): url for url in order}
+                for future in as_completed(futures):
+                    if on_result is not None:
+                        on_result(futures[future], future.result())
+            self.save()
+
+        with self.lock:
+            return {url: self.results[url] for url in unique}
+
+    # results is filled in by the worker threads while a scan runs, read it through these
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.results)
+
+    def result(self, url):
+        with self.lock:
+            return self.results.get(url)
+
+
+def dataset_urls(df):
+    if 'url' not in df.columns:
+        return []
+    return [url for urls in df['url'].tolist() for url in urls]
+
+
+def dead_link_rows(df, results):
+    # True for rows with at least one URL that was checked and didn't work
+    if 'url' not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    dead = {url for url, result in results.items() if not result['ok']}
+    return np.array([any(url in dead for url in urls) for urls in df['url'].tolist()], dtype=bool)
+
+
+def link_status_text(result):
+    if result is None:
+        return 'not checked'
+    if result['status'] is not None:
+        return f"{result['status']}" + ('' if result['ok'] else ' - not working')
+    return f"not working ({result['error']})"
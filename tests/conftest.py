@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import sys
+import types
+
+# Run from anywhere: the modules under test sit in the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# urlFileChecker.py has the server address and token and isn't checked in.
+# Nothing tested here talks to the server, so without it a placeholder will do.
+if importlib.util.find_spec('urlFileChecker') is None:
+    config = types.ModuleType('urlFileChecker')
+    config.url = 'http://127.0.0.1:9/download'
+    config.urlUpload = 'http://127.0.0.1:9/upload'
+    config.headers = {}
+    sys.modules['urlFileChecker'] = config
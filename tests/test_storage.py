@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+STORAGE_JS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fileHost', 'storage.js')
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason="needs node to run fileHost/storage.js")
+
+
+def run_store(directory, script):
+    # Loads a Store from directory, runs script with it as `store` and
+    # returns whatever the script passes to done()
+    program = f"""
+const {{ Store }} = require({json.dumps(STORAGE_JS)});
+(async () => {{
+    const store = new Store({json.dumps(str(directory))});
+    await store.load();
+    const done = value => process.stdout.write('RESULT ' + JSON.stringify(value === undefined ? null : value));
+    {script}
+}})().catch(err => {{ console.error(err); process.exit(1); }});
+"""
+    finished = subprocess.run(['node', '-e', program], capture_output=True, text=True, timeout=30)
+    assert finished.returncode == 0, finished.stderr
+    return json.loads(finished.stdout.split('RESULT ', 1)[1])
+
+
+def test_rows_get_ids_and_edits_survive_a_restart(tmp_path):
+    (tmp_path / 'target.csv').write_text('title,url\none,http://a/\ntwo,http://b/\n', encoding='utf-8')
+    assert run_store(tmp_path, "done(store.text());") == 'id,title,url\n1,one,http://a/\n2,two,http://b/\n'
+
+    run_store(tmp_path, """
+        await store.apply({ op: 'add', row: ',three,http://c/' });
+        await store.apply({ op: 'update', id: '1', old: '1,one,http://a/', row: '1,ONE,http://a/' });
+        await store.apply({ op: 'delete', id: '2', old: '2,two,http://b/' });
+        done();
+    """)
+    # Only the log has the edits, loading replays it
+    assert len((tmp_path / 'changes.log').read_text(encoding='utf-8').splitlines()) == 3
+    assert run_store(tmp_path, "done(store.text());") == 'id,title,url\n1,ONE,http://a/\n3,three,http://c/\n'
+
+
+def test_edit_of_a_row_that_changed_meanwhile_is_refused(tmp_path):
+    (tmp_path / 'target.csv').write_text('id,title\n1,one\n', encoding='utf-8')
+    result = run_store(tmp_path, """
+        const refused = store.apply({ op: 'update', id: '1', old: '1,not what is stored', row: '1,mine' });
+        done({ refused: refused === null, text: store.text() });
+    """)
+    assert result == {'refused': True, 'text': 'id,title\n1,one\n'}
+
+
+def test_half_written_log_entry_is_dropped(tmp_path):
+    (tmp_path / 'target.csv').write_text('id,title\n1,one\n', encoding='utf-8')
+    complete = json.dumps({'at': 1, 'op': 'add', 'row': '2,two'}) + '\n'
+    (tmp_path / 'changes.log').write_text(complete + '{"at": 2, "op": "add", "ro', encoding='utf-8')
+
+    assert run_store(tmp_path, "done(store.text());") == 'id,title\n1,one\n2,two\n'
+    assert (tmp_path / 'changes.log').read_text(encoding='utf-8') == complete
+
+
+def test_interrupted_compaction_is_finished_on_load(tmp_path):
+    # Crashed after the new snapshot was complete but before it replaced target.csv
+    (tmp_path / 'target.csv').write_text('id,title\n1,one\n', encoding='utf-8')
+    (tmp_path / 'changes.log').write_text(json.dumps({'at': 1, 'op': 'add', 'row': '2,two'}) + '\n', encoding='utf-8')
+    (tmp_path / 'target.csv.next').write_text('id,title\n1,one\n2,two\n', encoding='utf-8')
+
+    assert run_store(tmp_path, "done(store.text());") == 'id,title\n1,one\n2,two\n'
+    assert (tmp_path / 'target.csv').read_text(encoding='utf-8') == 'id,title\n1,one\n2,two\n'
+    assert not (tmp_path / 'target.csv.next').exists()
+    assert not (tmp_path / 'changes.log').exists()
+    assert [name for name in os.listdir(tmp_path / 'backups') if name.startswith('log-')]
+
+
+def test_history_goes_back_to_before_an_upload(tmp_path):
+    (tmp_path / 'target.csv').write_text('id,title\n1,one\n', encoding='utf-8')
+    result = run_store(tmp_path, """
+        await store.apply({ op: 'add', row: ',two' });
+        const before = Date.now();
+        await new Promise(resolve => setTimeout(resolve, 5));
+        await store.replace('id,title\\n9,uploaded\\n');
+        done({ then: await store.stateAt(before), now: store.text() });
+    """)
+    assert result['then'] == {'header': 'id,title', 'rows': ['1,one', '2,two']}
+    assert result['now'] == 'id,title\n9,uploaded\n'
+
+
+def test_compaction_keeps_old_style_backups(tmp_path):
+    (tmp_path / 'backups').mkdir()
+    legacy = tmp_path / 'backups' / 'backup-2023-10-05T03-54-11-622Z.csv'
+    legacy.write_text('title\nold\n', encoding='utf-8')
+    (tmp_path / 'target.csv').write_text('id,title\n1,one\n', encoding='utf-8')
+
+    run_store(tmp_path, "await store.replace('id,title\\n1,ONE\\n'); done();")
+    assert legacy.exists()
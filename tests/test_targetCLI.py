@@ -0,0 +1,93 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import targetCLI
+
+HEADER = 'title,activity,geo_target,url,live,end date,business_unit,environment'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # A few pages that work, one that doesn't and redirects to both
+    def do_HEAD(self):
+        if self.path in ('/ok', '/also-ok'):
+            self.send_response(200)
+        elif self.path == '/moved':
+            self.send_response(301)
+            self.send_header('Location', '/ok')
+        elif self.path == '/moved-away':
+            self.send_response(302)
+            self.send_header('Location', '/missing')
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def write_csv(path, rows):
+    lines = [HEADER] + [f"{title},A/B,False,{';'.join(urls)},True,NAN,Corp,QALV" for title, urls in rows]
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(path)
+
+
+def check_links(path):
+    targetCLI.main(['--no-cache', 'check-links', '--file', path, '--fresh'])
+
+
+def test_check_links_passes_when_every_url_works(server, tmp_path, capsys):
+    path = write_csv(tmp_path / 'links.csv', [
+        ('first', [f"{server}/ok"]),
+        ('second', [f"{server}/also-ok", f"{server}/moved"]),
+    ])
+    check_links(path)
+
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert '3 URLs checked' in err and '0 not working' in err
+
+
+def test_check_links_lists_broken_urls_and_fails(server, tmp_path, capsys):
+    path = write_csv(tmp_path / 'links.csv', [
+        ('working', [f"{server}/ok", f"{server}/moved"]),
+        ('gone', [f"{server}/missing"]),
+        ('redirected', [f"{server}/ok", f"{server}/moved-away"]),
+    ])
+    with pytest.raises(SystemExit) as exit_info:
+        check_links(path)
+    assert exit_info.value.code == 1
+
+    out, err = capsys.readouterr()
+    assert sorted(out.splitlines()) == [
+        f"404 - not working\t{server}/missing\tgone",
+        f"404 - not working\t{server}/moved-away\tredirected",
+    ]
+    assert '4 URLs checked' in err and '2 not working' in err
+
+
+def test_check_links_reports_servers_that_do_not_answer(tmp_path, capsys):
+    # Nothing listens on port 9, the connection is refused straight away
+    path = write_csv(tmp_path / 'links.csv', [('offline', ['http://127.0.0.1:9/page'])])
+    with pytest.raises(SystemExit) as exit_info:
+        check_links(path)
+    assert exit_info.value.code == 1
+
+    out, err = capsys.readouterr()
+    assert out == "not working (ConnectionError)\thttp://127.0.0.1:9/page\toffline\n"
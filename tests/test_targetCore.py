@@ -0,0 +1,119 @@
+import json
+
+from targetCore import EditJournal, apply_delta
+
+
+def row(row_id, title):
+    return f"{row_id},{title},A/B,False,http://example.com/,True,NAN,Corp,QALV"
+
+
+def saved(journal):
+    with open(journal.path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_apply_delta_replaces_rows():
+    rows = [row(1, 'one'), row(2, 'two'), row(3, 'three')]
+    assert apply_delta(rows, [row(2, 'two')], [row(2, 'TWO')]) == [row(1, 'one'), row(3, 'three'), row(2, 'TWO')]
+
+
+def test_apply_delta_removes_duplicates_one_at_a_time():
+    rows = ['a', 'b', 'a', 'a']
+    assert apply_delta(rows, ['a', 'a'], []) == ['b', 'a']
+
+
+def test_apply_delta_ignores_rows_it_does_not_have():
+    assert apply_delta(['a', 'b'], ['c'], ['d']) == ['a', 'b', 'd']
+
+
+def test_edits_to_the_same_row_go_out_once(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.record('7', row(7, 'old'), row(7, 'first'))
+    journal.record('7', row(7, 'first'), row(7, 'second'))
+    journal.record('8', row(8, 'old'), row(8, 'other'))
+
+    assert journal.entries == [
+        {'op': 'update', 'id': '7', 'old': row(7, 'old'), 'row': row(7, 'second')},
+        {'op': 'update', 'id': '8', 'old': row(8, 'old'), 'row': row(8, 'other')},
+    ]
+    assert saved(journal) == journal.entries
+
+
+def test_new_row_is_an_add_and_takes_its_edits(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.record('new-1', None, row('', 'added'))
+    journal.record('new-1', row('', 'added'), row('', 'edited'))
+
+    assert journal.entries == [{'op': 'add', 'id': 'new-1', 'old': None, 'row': row('', 'edited')}]
+
+
+def test_edits_behind_a_sending_batch_wait_for_the_next_one(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.record('7', row(7, 'old'), row(7, 'first'))
+    batch = journal.take()
+    journal.record('7', row(7, 'first'), row(7, 'second'))
+
+    assert [entry['row'] for entry in batch] == [row(7, 'first')]
+    assert journal.waiting() == [{'op': 'update', 'id': '7', 'old': row(7, 'first'), 'row': row(7, 'second')}]
+
+    journal.sent()
+    assert journal.entries == saved(journal) == [{'op': 'update', 'id': '7', 'old': row(7, 'first'), 'row': row(7, 'second')}]
+
+
+def test_failed_add_takes_the_edits_queued_behind_it(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.record('new-1', None, row('', 'added'))
+    journal.take()
+    # The add is on its way, so this one is an update of the row it creates
+    journal.record('new-1', row('', 'added'), row('', 'edited'))
+    assert journal.waiting()[0]['op'] == 'update'
+
+    journal.failed()
+    assert journal.sending == 0
+    assert journal.entries == saved(journal) == [{'op': 'add', 'id': 'new-1', 'old': None, 'row': row('', 'edited')}]
+
+
+def test_load_folds_edits_into_an_add_that_never_got_an_answer(tmp_path):
+    path = tmp_path / 'edits.json'
+    path.write_text(json.dumps([
+        {'op': 'add', 'id': 'new-1', 'old': None, 'row': row('', 'added')},
+        {'op': 'update', 'id': 'new-1', 'old': row('', 'added'), 'row': row('', 'edited')},
+        {'op': 'update', 'id': '7', 'old': row(7, 'old'), 'row': row(7, 'new')},
+    ]), encoding='utf-8')
+
+    journal = EditJournal(str(path))
+    assert journal.entries == [
+        {'op': 'add', 'id': 'new-1', 'old': None, 'row': row('', 'edited')},
+        {'op': 'update', 'id': '7', 'old': row(7, 'old'), 'row': row(7, 'new')},
+    ]
+
+
+def test_unreadable_journal_starts_empty(tmp_path):
+    path = tmp_path / 'edits.json'
+    path.write_text('{not json', encoding='utf-8')
+    assert EditJournal(str(path)).entries == []
+
+
+def test_rename_points_queued_edits_at_the_stored_row(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.record('new-1', None, row('', 'added'))
+    journal.take()
+    journal.record('new-1', row('', 'added'), row('', 'edited'))
+    journal.sent()
+
+    journal.rename('new-1', row(42, 'added'))
+    assert journal.entries == saved(journal) == [
+        {'op': 'update', 'id': '42', 'old': row(42, 'added'), 'row': row(42, 'edited')},
+    ]
+
+
+def test_rebase_sends_ours_again_on_top_of_theirs(tmp_path):
+    journal = EditJournal(str(tmp_path / 'edits.json'))
+    journal.rebase('7', row(7, 'theirs'), row(7, 'mine'))
+    assert journal.entries == [{'op': 'update', 'id': '7', 'old': row(7, 'theirs'), 'row': row(7, 'mine')}]
+
+    # A newer edit of ours already waiting goes instead, from their row
+    journal.record('8', row(8, 'old'), row(8, 'newer'))
+    journal.rebase('8', row(8, 'theirs'), row(8, 'mine'))
+    assert journal.entries[-1] == {'op': 'update', 'id': '8', 'old': row(8, 'theirs'), 'row': row(8, 'newer')}
+    assert journal.row_ids() == {'7', '8'}